@@ -0,0 +1,111 @@
+# -*- encoding: utf-8 -*-
+#
+# The Qubes OS Project, https://www.qubes-os.org/
+#
+# Copyright (C) 2016 Bahtiar `kalkin-` Gadimov <bahtiar@gadimov.de>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+''' Import time guard of the service modules.
+
+Imports every module in a fresh interpreter with `python3 -X importtime`
+and fails if the cumulative import time exceeds the budget, or if the
+import installs the GLib main loop as a side effect (see
+`qubesdbus.service.setup_loop`). Needs neither qubesd nor a bus:
+
+    python3 benchmarks/importtime.py [--budget MS] [MODULE …]
+'''
+
+import argparse
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+# pylint: disable=wrong-import-position
+from qubesdbus.constants import SERVICE_MODULES
+
+# modules which only `main()` may import
+MAIN_ONLY_MODULES = ['gbulb', 'dbus.mainloop.glib']
+
+
+def import_times(module):
+    ''' Import `module` in a new interpreter, returns a dictionary of
+        imported module → (self time, cumulative time) in microseconds
+    '''
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        filter(None, [ROOT, env.get('PYTHONPATH')]))
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+        env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        universal_newlines=True)
+    times = {}
+    errors = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:'):
+            errors.append(line)
+            continue
+        fields = line[len('import time:'):].split('|')
+        try:
+            self_us, cumulative_us = int(fields[0]), int(fields[1])
+        except ValueError:  # the header line
+            continue
+        times[fields[2].strip()] = (self_us, cumulative_us)
+    if proc.returncode != 0:
+        raise RuntimeError('\n'.join(errors))
+    return times
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--budget', metavar='MS', type=float, default=300,
+                        help='maximum cumulative import time per module '
+                        '(default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='take the fastest of N imports '
+                        '(default: %(default)s)')
+    parser.add_argument('--top', type=int, default=5,
+                        help='show the N slowest imports of each module')
+    parser.add_argument('modules', metavar='MODULE', nargs='*',
+                        default=SERVICE_MODULES)
+    args = parser.parse_args(args)
+
+    failed = False
+    for module in args.modules:
+        try:
+            runs = [import_times(module) for _ in range(args.repeat)]
+        except RuntimeError as e:
+            print('%s: import failed\n%s' % (module, e))
+            failed = True
+            continue
+        times = min(runs, key=lambda t: t[module][1])
+        total_ms = times[module][1] / 1000
+        over = total_ms > args.budget
+        print('%-28s %8.1f ms%s' % (module, total_ms,
+                                    '  OVER BUDGET' if over else ''))
+        slowest = sorted(times.items(), key=lambda i: i[1][0], reverse=True)
+        for name, (self_us, _) in slowest[:args.top]:
+            print('    %-40s %8.1f ms' % (name, self_us / 1000))
+        side_effects = [m for m in MAIN_ONLY_MODULES if m in times]
+        if side_effects:
+            print('    imports %s, only main() may do that'
+                  % ', '.join(side_effects))
+        failed = failed or over or bool(side_effects)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
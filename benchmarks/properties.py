@@ -0,0 +1,151 @@
+# -*- encoding: utf-8 -*-
+#
+# The Qubes OS Project, https://www.qubes-os.org/
+#
+# Copyright (C) 2016 Bahtiar `kalkin-` Gadimov <bahtiar@gadimov.de>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+''' Cost of reading the properties of many objects.
+
+Compares reading N objects with one `org.freedesktop.DBus.Properties.GetAll`
+call per object against a single `GetProperties` call on the manager, for
+all properties and for the few a client like a domain widget needs. A
+server process with N domain-like `qubesdbus.service.PropertiesObject`s is
+started per object count on the session bus, qubesd is not needed:
+
+    python3 benchmarks/properties.py [--objects N …] [--iterations N]
+'''
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+import dbus
+import dbus.service
+
+BUS_NAME = 'org.qubes.Benchmark1'
+PATH = '/org/qubes/Benchmark1'
+INTERFACE = 'org.qubes.Benchmark1'
+# properties read by the selective `GetProperties`
+NAMES = ['name', 'label', 'state']
+# number of additional properties of every object, about as many as a domain
+EXTRA_PROPERTIES = 40
+
+
+def domain_data(qid):
+    ''' Returns domain-like properties of the domain `qid` '''
+    data = dbus.Dictionary({'qid': dbus.Int64(qid),
+                            'name': dbus.String('vm%d' % qid),
+                            'label': dbus.ObjectPath(
+                                '/org/qubes/Labels1/labels/red'),
+                            'state': dbus.String('Running')},
+                           signature='sv')
+    for i in range(EXTRA_PROPERTIES):
+        data['property%d' % i] = dbus.String('value%d' % i)
+    return data
+
+
+def serve(count):
+    ''' Run the benchmark server with `count` objects until terminated '''
+    # imported here, the client doesn't need qubesadmin and gbulb
+    import asyncio
+    import qubesdbus.service
+
+    class Manager(qubesdbus.service.ManagerObject):
+        def __init__(self, bus_name):
+            super().__init__(bus_name=bus_name, object_path=PATH)
+            self.domains = {}
+            for qid in range(count):
+                obj_path = os.path.join(PATH, 'domains', str(qid))
+                self.domains[obj_path] = qubesdbus.service.PropertiesObject(
+                    bus_name, obj_path, INTERFACE, domain_data(qid))
+
+        def objects(self):
+            return self.domains
+
+    qubesdbus.service.setup_loop()
+    bus_name = dbus.service.BusName(BUS_NAME, bus=dbus.SessionBus())
+    _manager = Manager(bus_name)
+    asyncio.get_event_loop().run_forever()
+
+
+def measure(count, iterations):
+    ''' Returns the durations in seconds of reading `count` objects for
+        every method
+    '''
+    server = subprocess.Popen([sys.executable, os.path.abspath(__file__),
+                               '--serve', str(count)])
+    try:
+        bus = dbus.SessionBus()
+        deadline = time.monotonic() + 10
+        while not bus.name_has_owner(BUS_NAME):
+            if time.monotonic() > deadline or server.poll() is not None:
+                raise RuntimeError('Benchmark server did not start')
+            time.sleep(0.05)
+        manager = bus.get_object(BUS_NAME, PATH)
+        paths = [os.path.join(PATH, 'domains', str(qid))
+                 for qid in range(count)]
+        proxies = [bus.get_object(BUS_NAME, p) for p in paths]
+
+        def get_all():
+            for proxy in proxies:
+                proxy.GetAll(INTERFACE,
+                             dbus_interface=dbus.PROPERTIES_IFACE)
+
+        def get_properties(names):
+            # org.qubes.Properties1, dispatched by the method name
+            result = manager.GetProperties(paths, names)
+            assert len(result) == count
+
+        methods = [('GetAll × %d' % count, get_all),
+                   ('GetProperties', lambda: get_properties([])),
+                   ('GetProperties %s' % ','.join(NAMES),
+                    lambda: get_properties(NAMES))]
+        durations = {name: [] for name, _ in methods}
+        for _ in range(iterations):
+            for name, func in methods:
+                start = time.monotonic()
+                func()
+                durations[name].append(time.monotonic() - start)
+        return [(name, durations[name]) for name, _ in methods]
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--objects', type=int, nargs='+', default=[50, 200])
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--serve', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args(args)
+    if args.serve:
+        serve(args.serve)
+        return 0
+
+    for count in args.objects:
+        print('%d objects' % count)
+        for name, durations in measure(count, args.iterations):
+            print('  %-34s median %8.2f ms  max %8.2f ms' % (
+                name, statistics.median(durations) * 1000,
+                max(durations) * 1000))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,179 @@
+# -*- encoding: utf-8 -*-
+#
+# The Qubes OS Project, https://www.qubes-os.org/
+#
+# Copyright (C) 2016 Bahtiar `kalkin-` Gadimov <bahtiar@gadimov.de>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+''' Event to state signal latency of `DomainManager1`.
+
+Compares the in-process state signals (`Domain.state_changed`, emitted
+after the batched `PropertiesChanged`) with the former self-subscription,
+where the manager received its own `PropertiesChanged` through the bus
+before emitting `Started`/`Halted`/… . A server process with a single
+`qubesdbus.models.Domain` is started per mode on the session bus, qubesd is
+not needed:
+
+    python3 benchmarks/state_signals.py [--iterations N]
+'''
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+import dbus
+import dbus.mainloop.glib
+import dbus.service
+
+BUS_NAME = 'org.qubes.Benchmark1'
+PATH = '/org/qubes/Benchmark1'
+INTERFACE = 'org.qubes.Benchmark1'
+MODES = ['loopback', 'inprocess']
+# the state machine cycle of a domain
+CYCLE = ['Starting', 'Started', 'Halting', 'Halted']
+
+
+def serve(mode):
+    ''' Run the benchmark server in `mode` until terminated '''
+    # imported here, the client doesn't need qubesadmin and gbulb
+    import asyncio
+    import qubesdbus.models
+    import qubesdbus.service
+
+    class Manager(dbus.service.Object):
+        def __init__(self, bus_name):
+            super().__init__(bus_name=bus_name, object_path=PATH)
+            data = dbus.Dictionary({'qid': dbus.Int64(1),
+                                    'name': dbus.String('benchmark'),
+                                    'state': dbus.String('Halted')},
+                                   signature='sv')
+            self.domain = qubesdbus.models.Domain(
+                bus_name, PATH, data,
+                state_changed=self.emit if mode == 'inprocess' else None)
+            self.signals = {state: getattr(self, state) for state in CYCLE}
+            if mode == 'loopback':
+                bus_name.get_bus().add_signal_receiver(
+                    self.properties_changed,
+                    signal_name='PropertiesChanged',
+                    dbus_interface='org.freedesktop.DBus.Properties',
+                    path=self.domain.id)
+
+        def emit(self, domain, state):
+            # like DomainManager._emit_state_signal
+            domain.queue_signal(self.signals[state], domain.id)
+
+        def properties_changed(self, _, changed, invalidated=None):
+            # like the former DomainManager._setup_state_signals
+            # pylint: disable=unused-argument
+            if 'state' in changed:
+                self.signals[changed['state']](self.domain.id)
+
+        @dbus.service.method(INTERFACE)
+        def Next(self):
+            ''' Move the domain to the next state, like a qubesd event '''
+            state = self.domain.properties['state']
+            new_state = CYCLE[(CYCLE.index(state) + 1) % len(CYCLE)]
+            self.domain.Set('org.freedesktop.DBus.Properties', 'state',
+                            new_state)
+
+        @dbus.service.signal(INTERFACE, signature='o')
+        def Starting(self, obj_path):
+            pass
+
+        @dbus.service.signal(INTERFACE, signature='o')
+        def Started(self, obj_path):
+            pass
+
+        @dbus.service.signal(INTERFACE, signature='o')
+        def Halting(self, obj_path):
+            pass
+
+        @dbus.service.signal(INTERFACE, signature='o')
+        def Halted(self, obj_path):
+            pass
+
+    qubesdbus.service.setup_loop()
+    bus_name = dbus.service.BusName(BUS_NAME, bus=dbus.SessionBus())
+    _manager = Manager(bus_name)
+    asyncio.get_event_loop().run_forever()
+
+
+def measure(mode, iterations):
+    ''' Returns the event to signal latencies of `mode` in seconds '''
+    from gi.repository import GLib
+
+    server = subprocess.Popen([sys.executable, os.path.abspath(__file__),
+                               '--serve', mode])
+    try:
+        bus = dbus.SessionBus()
+        deadline = time.monotonic() + 10
+        while not bus.name_has_owner(BUS_NAME):
+            if time.monotonic() > deadline or server.poll() is not None:
+                raise RuntimeError('Benchmark server did not start')
+            time.sleep(0.05)
+        proxy = bus.get_object(BUS_NAME, PATH)
+        loop = GLib.MainLoop()
+        received = []
+
+        def signal_received(*_):
+            received.append(time.monotonic())
+            loop.quit()
+
+        for state in CYCLE:
+            bus.add_signal_receiver(signal_received, signal_name=state,
+                                    dbus_interface=INTERFACE, path=PATH)
+
+        latencies = []
+        for _ in range(iterations):
+            start = time.monotonic()
+            proxy.Next(dbus_interface=INTERFACE,
+                       reply_handler=lambda: None,
+                       error_handler=lambda e: print(e, file=sys.stderr))
+            timeout = GLib.timeout_add(5000, loop.quit)
+            loop.run()
+            GLib.source_remove(timeout)
+            if not received:
+                raise RuntimeError('No state signal received')
+            latencies.append(received.pop() - start)
+        return latencies
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--iterations', type=int, default=1000)
+    parser.add_argument('--serve', choices=MODES, help=argparse.SUPPRESS)
+    args = parser.parse_args(args)
+    if args.serve:
+        serve(args.serve)
+        return 0
+
+    dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+    for mode in MODES:
+        latencies = sorted(measure(mode, args.iterations))
+        print('%-10s median %7.3f ms  p95 %7.3f ms  max %7.3f ms' % (
+            mode, statistics.median(latencies) * 1000,
+            latencies[int(len(latencies) * 0.95)] * 1000,
+            latencies[-1] * 1000))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,128 @@
+# -*- encoding: utf-8 -*-
+#
+# The Qubes OS Project, https://www.qubes-os.org/
+#
+# Copyright (C) 2016 Bahtiar `kalkin-` Gadimov <bahtiar@gadimov.de>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+''' Startup time of the `Devices1` topology build.
+
+Runs `qubesdbus.device_manager.build_topology` against a generated system
+with many domains. The Admin API calls are answered by `SyntheticQubes`,
+each taking `--latency` milliseconds like a qubesd round trip, so neither
+qubesd nor a bus is needed:
+
+    python3 benchmarks/topology.py [--domains N] [--latency MS]
+
+The topology is built once per `--workers` value, one worker is the
+sequential baseline.
+'''
+
+import argparse
+import sys
+import threading
+import time
+
+import qubesadmin.app
+import qubesadmin.exc
+
+import qubesdbus.device_manager as device_manager
+
+
+class SyntheticQubes(qubesadmin.app.QubesBase):
+    ''' Answers the Admin API calls of `build_topology` for `domains`
+        domains and `backends` backend domains with `devices` devices per
+        device class. The first device of every backend and class is
+        attached to a domain.
+    '''
+
+    def __init__(self, domains, backends, devices, latency):
+        super().__init__()
+        self.latency = latency
+        self.calls = 0
+        self.lock = threading.Lock()
+        self.backends = ['sys-usb%d' % i for i in range(backends)]
+        self.appvms = ['vm%d' % i for i in range(domains)]
+        names = ['dom0'] + self.backends + self.appvms
+        self.qids = {name: qid for qid, name in enumerate(names)}
+        self.devices = devices
+
+    def qubesd_call(self, dest, method, arg=None, payload=None,
+                    payload_stream=False):
+        # pylint: disable=unused-argument,too-many-return-statements
+        with self.lock:
+            self.calls += 1
+        time.sleep(self.latency)
+        if method == 'admin.vm.List':
+            return ''.join(
+                '%s class=%s state=Running\n' % (
+                    name, 'AdminVM' if name == 'dom0' else 'AppVM')
+                for name in self.qids).encode()
+        if method == 'admin.vm.property.Get':
+            if arg == 'qid':
+                return b'default=False type=int %d' % self.qids[dest]
+            return b'default=True type=str '
+        if method.startswith('admin.vm.device.'):
+            dev_class, call = method.split('.')[3:5]
+            if call == 'Available':
+                if dest not in self.backends:
+                    return b''
+                return ''.join(
+                    '%s%d description=%s_device_%d\n' % (
+                        dev_class, i, dev_class, i)
+                    for i in range(self.devices)).encode()
+            if call == 'List':
+                # attach the first device of each backend to one domain
+                return ''.join(
+                    '%s+%s0 persistent=no\n' % (backend, dev_class)
+                    for i, backend in enumerate(self.backends)
+                    if self.appvms[i % len(self.appvms)] == dest).encode()
+        raise qubesadmin.exc.QubesException(
+            'Unexpected call %s %s %s' % (dest, method, arg))
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--domains', type=int, default=120)
+    parser.add_argument('--backends', type=int, default=3)
+    parser.add_argument('--devices', type=int, default=8,
+                        help='devices per backend and class')
+    parser.add_argument('--latency', metavar='MS', type=float, default=1,
+                        help='duration of an Admin API call')
+    parser.add_argument('--workers', type=int, nargs='+',
+                        default=[1, device_manager.TOPOLOGY_WORKERS])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args(args)
+
+    for workers in args.workers:
+        device_manager.TOPOLOGY_WORKERS = workers
+        times = []
+        for _ in range(args.repeat):
+            app = SyntheticQubes(args.domains, args.backends, args.devices,
+                                 args.latency / 1000)
+            start = time.monotonic()
+            devices = device_manager.build_topology(app,
+                                                    device_manager.DEV_TYPES)
+            times.append(time.monotonic() - start)
+        attached = sum(1 for _, data in devices.values()
+                       if data.get('frontend_domain'))
+        print('%2d workers: %8.1f ms  (%d domains, %d devices, %d attached, '
+              '%d calls)' % (workers, min(times) * 1000, args.domains,
+                             len(devices), attached, app.calls))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
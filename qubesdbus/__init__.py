@@ -17,12 +17,42 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
+''' Qubes D-Bus services. The submodules are imported on first access, so
+    starting a single service doesn't import all the others. Python before
+    3.7 has no module `__getattr__` (PEP 562) and imports them eagerly.
+'''
 from __future__ import absolute_import
 
+import importlib
+import sys
+
 from .constants import * # pylint: disable=wildcard-import
-from .models import Domain, Label
-from .domain_manager import DomainManager
-from .labels import Labels
 from .constants import NAME_PREFIX, PATH_PREFIX, VERSION
 from .exceptions import QubesDbusException
-from . import serialize
+
+# lazily imported name → submodule
+_LAZY_ATTRIBUTES = {
+    'Domain': 'models',
+    'Label': 'models',
+    'DomainManager': 'domain_manager',
+    'Labels': 'labels',
+    'serialize': 'serialize',
+}
+
+
+def __getattr__(name):
+    ''' Import the submodule providing `name` on first access (PEP 562) '''
+    try:
+        module_name = _LAZY_ATTRIBUTES[name]
+    except KeyError:
+        raise AttributeError("module %r has no attribute %r" % (__name__,
+                                                                name))
+    module = importlib.import_module('.' + module_name, __name__)
+    value = module if name == module_name else getattr(module, name)
+    globals()[name] = value
+    return value
+
+
+if sys.version_info < (3, 7):
+    for _name in _LAZY_ATTRIBUTES:
+        __getattr__(_name)
@@ -1,3 +1,9 @@
 PATH_PREFIX = '/org/qubes'
 NAME_PREFIX = 'org.qubes'
 VERSION = 1
+# modules started by the bus activation files in dbus-1/services
+SERVICE_MODULES = [
+    'qubesdbus.domain_manager',
+    'qubesdbus.device_manager',
+    'qubesdbus.labels',
+]
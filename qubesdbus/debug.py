@@ -0,0 +1,134 @@
+# -*- encoding: utf-8 -*-
+# pylint: disable=invalid-name
+#
+# The Qubes OS Project, https://www.qubes-os.org/
+#
+# Copyright (C) 2016 Bahtiar `kalkin-` Gadimov <bahtiar@gadimov.de>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+''' `org.qubes.Debug1` interface for profiling a running service.
+
+Nothing is traced until a session is started, so the interface costs nothing
+when unused.
+'''
+
+import asyncio
+import cProfile
+import logging
+import os
+import tempfile
+import tracemalloc
+
+import dbus
+import dbus.service
+from dbus.service import BusName
+
+INTERFACE = 'org.qubes.Debug1'
+
+# upper bound for the duration of a profiling session in seconds
+MAX_DURATION = 600
+
+log = logging.getLogger('qubesdbus.debug')
+
+
+class Debug(dbus.service.Object):
+    ''' Exported at `SERVICE_PATH/debug` by every service. Profiles and
+        memory snapshots are written to new private files in
+        `$XDG_RUNTIME_DIR` (or the temporary directory) and the methods return
+        the file path.
+    '''
+
+    def __init__(self, bus_name: BusName, service_path: str) -> None:
+        super().__init__(bus_name=bus_name,
+                         object_path=os.path.join(service_path, 'debug'))
+        self.service = bus_name.get_name()
+        self.profile = None  # type: cProfile.Profile
+        self.profile_path = None  # type: str
+        self.profile_timer = None  # type: asyncio.Handle
+        self.tracemalloc_path = None  # type: str
+
+    def _output_path(self, suffix: str) -> str:
+        ''' Create a new private output file and return its path. The name is
+            unpredictable and the file is created exclusively, so a link
+            planted in a shared temporary directory is never followed.
+        '''
+        fd, path = tempfile.mkstemp(
+            prefix='%s-%d-' % (self.service, os.getpid()),
+            suffix='.' + suffix, dir=os.environ.get('XDG_RUNTIME_DIR'))
+        os.close(fd)
+        return path
+
+    @staticmethod
+    def _duration(seconds) -> int:
+        if not 0 < seconds <= MAX_DURATION:
+            raise dbus.DBusException(
+                "Duration has to be between 1 and %d seconds" % MAX_DURATION,
+                name="InvalidArgs")
+        return seconds
+
+    @dbus.service.method(INTERFACE, in_signature="u", out_signature="s")
+    def StartProfile(self, seconds):
+        ''' Start a `cProfile` session for at most `seconds`. Returns the path
+            the profile is written to when the session ends.
+        '''
+        seconds = self._duration(seconds)
+        if self.profile is not None:
+            raise dbus.DBusException("Profiling already in progress",
+                                     name="InProgress")
+        self.profile_path = self._output_path('prof')
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+        self.profile_timer = asyncio.get_event_loop().call_later(
+            seconds, self.StopProfile)
+        log.info('Profiling for %ds into %s', seconds, self.profile_path)
+        return self.profile_path
+
+    @dbus.service.method(INTERFACE, out_signature="s")
+    def StopProfile(self):
+        ''' Stop the running `cProfile` session and write the profile.
+            Returns the path of the written profile.
+        '''
+        if self.profile is None:
+            raise dbus.DBusException("No profiling in progress",
+                                     name="NotInProgress")
+        self.profile.disable()
+        self.profile_timer.cancel()
+        self.profile.dump_stats(self.profile_path)
+        log.info('Profile written to %s', self.profile_path)
+        self.profile = None
+        self.profile_timer = None
+        return self.profile_path
+
+    @dbus.service.method(INTERFACE, in_signature="u", out_signature="s")
+    def TraceMemory(self, seconds):
+        ''' Trace memory allocations for `seconds` and write a `tracemalloc`
+            snapshot. Returns the path the snapshot is written to.
+        '''
+        seconds = self._duration(seconds)
+        if tracemalloc.is_tracing():
+            raise dbus.DBusException("Memory tracing already in progress",
+                                     name="InProgress")
+        self.tracemalloc_path = self._output_path('tracemalloc')
+        tracemalloc.start()
+        asyncio.get_event_loop().call_later(seconds, self._snapshot)
+        log.info('Tracing memory for %ds into %s', seconds,
+                 self.tracemalloc_path)
+        return self.tracemalloc_path
+
+    def _snapshot(self) -> None:
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        snapshot.dump(self.tracemalloc_path)
+        log.info('Memory snapshot written to %s', self.tracemalloc_path)
@@ -18,15 +18,26 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 ''' org.qubes.DeviceManager1 Service '''
+import argparse
 import asyncio
+import collections
+import concurrent.futures
+import functools
 import logging
+import multiprocessing
 import os
 import re
 import sys
+import time
 
 import dbus.service
 import systemd.journal
 
+import qubesadmin
+import qubesadmin.devices
+import qubesdbus.debug
+import qubesdbus.device_shard
+import qubesdbus.export
 import qubesdbus.serialize
 import qubesdbus.service
 
@@ -40,43 +51,95 @@ SERVICE_NAME = "org.qubes.Devices1"
 SERVICE_PATH = "/org/qubes/Devices1"
 DEV_TYPES = ['block', 'pci', 'usb', 'mic']
 DEV_IFACE = 'org.qubes.Device'
+# number of domains queried concurrently on startup
+TOPOLOGY_WORKERS = 8
+# delay before restarting a dead worker in seconds, doubled on every failure
+# until the worker delivers a snapshot again
+SHARD_RESTART_DELAY = 1
+SHARD_RESTART_MAX_DELAY = 300
+# seconds to wait for the initial snapshots of the workers
+SHARD_START_TIMEOUT = 60
 
 DBusSignalMatch = dbus.connection.SignalMatch
 
 
 class DeviceManager(qubesdbus.service.ObjectManager):
-    def __init__(self) -> None:
+    ''' Implements `org.qubes.Devices1`. In sharded mode every device class
+        is handled by a worker process (see `qubesdbus.device_shard`), which
+        talks to qubesd and pushes updates to this process.
+    '''
+
+    def __init__(self, sharded: bool = False, checkpoint=None) -> None:
         super().__init__(SERVICE_NAME, SERVICE_PATH)
         self.devices = {}  # type: Dict[str, Device]
-
-        for vm in self.app.domains:
-            for dev_class in DEV_TYPES:
-                for dev_info in vm.devices[dev_class].available():
-                    obj_path, device = self._device(vm, dev_class, dev_info)
-                    self.devices[obj_path] = device
-
-        for vm in self.app.domains:
+        # (backend name, dev_class, ident) → device object path
+        self.device_ids = {}  # type: Dict[Tuple[str, str, str], str]
+        # frontend domain path → attached device object paths
+        self.frontend_devices = {}  # type: Dict[str, Set[str]]
+        self.journal = qubesdbus.service.ChangeJournal()
+        self.debug = qubesdbus.debug.Debug(self.bus_name, SERVICE_PATH)
+        self.domain_index = DomainIndex(self.app)
+        # separate client for the verification running in the executor
+        self.verify_app = qubesadmin.Qubes()
+
+        self.connected = False
+        self.repaired = 0
+        self.sharded = sharded
+        # dev_class → (worker process, connection) of the running workers
+        self.shards = {}  # type: Dict[str, Tuple[Any, Any]]
+        # dev_class → restart delay of workers which died without snapshot
+        self.shard_delays = {}  # type: Dict[str, int]
+        # dev_class → futures waiting for the next snapshot of the worker,
+        # resolved with the number of repaired devices
+        self.snapshot_waiters = {}  # type: Dict[str, List[asyncio.Future]]
+
+        if checkpoint is not None:  # refreshed by catch_up()
+            for obj_path, data in checkpoint['objects'].items():
+                self._register_device(checkpoint['state'][obj_path],
+                                      obj_path, data)
+
+        if sharded:
             for dev_class in DEV_TYPES:
-                for assignment in vm.devices[dev_class].attached():
+                self._start_shard(dev_class)
+            if checkpoint is None:
+                # wait for the initial snapshots, built concurrently by
+                # workers
+                deadline = time.monotonic() + SHARD_START_TIMEOUT
+                for dev_class, (_, conn) in list(self.shards.items()):
                     try:
-                        obj_path, frontend_vm_path = self._frontend_domain(
-                            vm, assignment, dev_class)
-                        self.devices[obj_path].properties[
-                            'frontend_domain'] = dbus.ObjectPath(
-                                frontend_vm_path)
-                        if assignment.options:
-                            self.devices[obj_path].properties[
-                                'attach_options'] = assignment.options
-                    except TypeError:
-                        continue
+                        received = conn.poll(
+                            max(0, deadline - time.monotonic()))
+                        if received:
+                            self._shard_message(conn.recv())
+                        else:
+                            log.error('Worker for %s devices sent no '
+                                      'snapshot in %ds', dev_class,
+                                      SHARD_START_TIMEOUT)
+                    except EOFError:
+                        received = False
+                    if not received:
+                        self._shard_died(dev_class)
+                self.repaired = 0  # the initial snapshots repair nothing
+            return
+
+        if checkpoint is None:
+            qids = {}  # type: Dict[str, int]
+            for obj_path, (backend_name, data) in build_topology(
+                    self.app, DEV_TYPES, qids).items():
+                self._register_device(backend_name, obj_path, data)
+            self.domain_index.update(qids)
 
         for dev_class in DEV_TYPES:
-            self.events_dispatcher.add_handler(
-                'device-list-change:%s' % dev_class, self._device_changes)
-            self.events_dispatcher.add_handler('device-attach:%s' % dev_class,
-                                               self._device_attached)
-            self.events_dispatcher.add_handler('device-detach:%s' % dev_class,
-                                               self._device_detached)
+            self.add_event_handler('device-list-change:%s' % dev_class,
+                                   self._device_changes)
+            self.add_event_handler('device-attach:%s' % dev_class,
+                                   self._device_attached)
+            self.add_event_handler('device-detach:%s' % dev_class,
+                                   self._device_detached)
+        self.add_event_handler('domain-add', self._domain_add)
+        self.add_event_handler('domain-delete', self._domain_delete)
+        self.add_event_handler('connection-established',
+                               self._connection_established)
 
     @dbus.service.method(dbus_interface="org.freedesktop.DBus.ObjectManager",
                          out_signature="a{oa{sa{sv}}}")
@@ -89,15 +152,21 @@ class DeviceManager(qubesdbus.service.ObjectManager):
             for o in self.devices.values()
         }
 
+    def objects(self):
+        return self.devices
+
     def _device_changes(self, vm, event, **_):
         ''' Event handler for 'device-list-changes:DEV_CLASS' '''
         dev_class = event.split(':', 1)[1]
-        paths = []
-        for dev_info in vm.devices[dev_class].available():
-            obj_path = device_path(vm, dev_class, dev_info.ident)
-            paths.append(obj_path)
-
-        vm_path_prefix = os.path.join(SERVICE_PATH, dev_class, str(vm.qid))
+        self._apply_device_list(vm.name, vm.qid, dev_class,
+                                device_list(vm, dev_class))
+
+    def _apply_device_list(self, backend_name, qid, dev_class, entries):
+        ''' Replace the `dev_class` devices of a backend domain with
+            `entries`, a list of `(object path, device data)`.
+        '''
+        paths = set(obj_path for obj_path, _ in entries)
+        vm_path_prefix = os.path.join(SERVICE_PATH, dev_class, str(qid))
         known_devices = [
             p for p in self.devices if p.startswith(vm_path_prefix + '/')
         ]
@@ -106,95 +175,356 @@ class DeviceManager(qubesdbus.service.ObjectManager):
         for obj_path in known_devices:
             if obj_path not in paths:
                 self.Removed(obj_path)
-                self.devices[obj_path].remove_from_connection()
-                del self.devices[obj_path]
+                self._unregister_device(backend_name, obj_path)
+                self.journal.record(obj_path, 'removed')
 
         # add & update all own existing devices
-        for dev_info in vm.devices[dev_class].available():
-            obj_path = device_path(vm, dev_class, dev_info.ident)
+        for obj_path, data in entries:
             try:  # update an existing device
-                original_dev = self.devices[obj_path]
-                for key, value in original_dev.properties.items():
-                    if original_dev.properties[key] != value:
-                        original_dev.Set(None, key, value)
+                self.devices[obj_path].update_properties(
+                    data, keep=('frontend_domain', 'attach_options'))
             except KeyError:  # add new device
-                obj_path, device = self._device(vm, dev_class, dev_info)
-                self.devices[obj_path] = device
+                self._register_device(backend_name, obj_path, data)
+                self.journal.record(obj_path, 'added')
                 self.Added(obj_path)
 
-    def _device(self, vm, dev_class, dev_info):
-        data = qubesdbus.serialize.device_data(dev_info)
-        data['dev_class'] = dev_class
-        obj_path = device_path(vm, dev_class, data['ident'])
-        device = Device(self.bus_name, obj_path, data)
-        return (obj_path, device)
+    def _domain_add(self, _, __, vm=None, **___):
+        try:
+            self.domain_index.add(self.app.domains[vm])
+        except KeyError:  # already removed again
+            pass
+
+    def _domain_delete(self, _, __, vm=None, **___):
+        self.domain_index.remove(vm)
+
+    def _connection_established(self, *_, **__):
+        if self.connected:  # reconnected, events may have been missed
+            asyncio.ensure_future(self.verify())
+        self.connected = True
+
+    def _topology(self, qids):
+        ''' Returns the current topology, see `build_topology`. Blocking,
+            called from the executor.
+        '''
+        self.verify_app.domains.clear_cache()
+        return build_topology(self.verify_app, DEV_TYPES, qids)
+
+    @asyncio.coroutine
+    def verify(self):
+        ''' Verify the exported devices against qubesd and repair the ones
+            which differ, emitting only the differences. The topology is
+            gathered in the executor, with a separate admin client, so method
+            calls are served meanwhile. In sharded mode the workers are asked
+            to resend their state instead. Returns the number of repaired
+            devices.
+        '''
+        if self.sharded:
+            waiters = []
+            for dev_class, (_, conn) in self.shards.items():
+                try:
+                    conn.send(('verify',))
+                except OSError:  # died, restarted with a fresh snapshot
+                    continue
+                future = asyncio.Future()
+                self.snapshot_waiters.setdefault(dev_class,
+                                                 []).append(future)
+                waiters.append(future)
+            repaired = sum((yield from asyncio.gather(*waiters)))
+            log.info('Verified %d devices, repaired %d', len(self.devices),
+                     repaired)
+            return repaired
+        qids = {}  # type: Dict[str, int]
+        devices = yield from asyncio.get_event_loop().run_in_executor(
+            None, self._topology, qids)
+        repaired = self._apply_topology(devices)
+        self.domain_index.update(qids)
+        self.repaired += repaired
+        log.info('Verified %d devices, repaired %d', len(self.devices),
+                 repaired)
+        return repaired
+
+    @asyncio.coroutine
+    def catch_up(self):
+        ''' Refresh a state restored from a checkpoint. In sharded mode the
+            initial worker snapshots do that.
+        '''
+        if not self.sharded:
+            yield from self.verify()
+
+    def checkpoint(self) -> None:
+        ''' Write the exported state for a fast resume on the next start '''
+        qubesdbus.service.write_checkpoint(
+            SERVICE_NAME, self.devices,
+            {p: d.backend_name for p, d in self.devices.items()})
+
+    def _apply_topology(self, devices, dev_class=None) -> int:
+        ''' Replace the exported devices (only the ones of `dev_class` if
+            given) with `devices`, as returned by `build_topology`, emitting
+            only the differences. Returns the number of changed devices.
+        '''
+        repaired = 0
+        for obj_path in list(self.devices):
+            properties = self.devices[obj_path].properties
+            if dev_class is not None and properties['dev_class'] != dev_class:
+                continue
+            if obj_path not in devices:
+                self.Removed(obj_path)
+                self._unregister_device(self.devices[obj_path].backend_name,
+                                        obj_path)
+                self.journal.record(obj_path, 'removed')
+                repaired += 1
+
+        for obj_path, (backend_name, data) in devices.items():
+            try:
+                device = self.devices[obj_path]
+            except KeyError:
+                self._register_device(backend_name, obj_path, data)
+                self.journal.record(obj_path, 'added')
+                self.Added(obj_path)
+                repaired += 1
+                continue
+            old_frontend = device.properties.get('frontend_domain')
+            if not device.update_properties(data):
+                continue
+            repaired += 1
+            new_frontend = device.properties.get('frontend_domain')
+            if old_frontend != new_frontend:
+                if old_frontend:
+                    self._unindex_frontend(old_frontend, obj_path)
+                    device.queue_signal(device.Detached, old_frontend)
+                    device.queue_signal(self.DeviceDetached, old_frontend,
+                                        obj_path)
+                if new_frontend:
+                    self.frontend_devices.setdefault(new_frontend,
+                                                     set()).add(obj_path)
+                    device.queue_signal(device.Attached, new_frontend)
+                    device.queue_signal(self.DeviceAttached, new_frontend,
+                                        obj_path)
+        return repaired
+
+    def _start_shard(self, dev_class) -> None:
+        ''' Start the worker process for `dev_class` '''
+        context = multiprocessing.get_context('spawn')
+        conn, child_conn = context.Pipe()
+        process = context.Process(target=qubesdbus.device_shard.worker,
+                                  args=(dev_class, child_conn),
+                                  name='qubesdbus-devices-%s' % dev_class,
+                                  daemon=True)
+        process.start()
+        child_conn.close()
+        self.shards[dev_class] = (process, conn)
+        asyncio.get_event_loop().add_reader(conn.fileno(),
+                                            self._shard_readable, dev_class)
+
+    def _shard_readable(self, dev_class) -> None:
+        _, conn = self.shards[dev_class]
+        try:
+            while conn.poll():
+                self._shard_message(conn.recv())
+        except EOFError:
+            self._shard_died(dev_class)
+
+    def _shard_died(self, dev_class) -> None:
+        ''' Clean up after a dead worker and restart it with a backoff '''
+        process, conn = self.shards.pop(dev_class)
+        for future in self.snapshot_waiters.pop(dev_class, []):
+            if not future.done():
+                future.set_result(0)
+        loop = asyncio.get_event_loop()
+        loop.remove_reader(conn.fileno())
+        conn.close()
+        self._reap_shard(process)
+        delay = self.shard_delays.get(dev_class, SHARD_RESTART_DELAY)
+        self.shard_delays[dev_class] = min(delay * 2,
+                                           SHARD_RESTART_MAX_DELAY)
+        log.error('Worker for %s devices died (exit code %s), restarting it '
+                  'in %ds', dev_class, process.exitcode, delay)
+        loop.call_later(delay, self._start_shard, dev_class)
+
+    def _reap_shard(self, process) -> None:
+        ''' Wait for a dead or hanging worker without blocking the event
+            loop, `is_alive()` reaps an exited process
+        '''
+        if process.is_alive():
+            process.terminate()
+            asyncio.get_event_loop().call_later(1, self._reap_shard, process)
+
+    def _shard_message(self, message) -> None:
+        ''' Apply an update pushed by a worker process '''
+        message = qubesdbus.service.from_plain(message)
+        kind = message[0]
+        if kind == 'snapshot':
+            _, dev_class, devices = message
+            self.shard_delays.pop(dev_class, None)  # the worker works
+            repaired = self._apply_topology(collections.OrderedDict(devices),
+                                            dev_class)
+            self.repaired += repaired
+            for future in self.snapshot_waiters.pop(dev_class, []):
+                if not future.done():
+                    future.set_result(repaired)
+        elif kind == 'list':
+            _, backend_name, qid, dev_class, entries = message
+            self._apply_device_list(backend_name, qid, dev_class, entries)
+        elif kind == 'attach':
+            _, dev_class, dev_str, vm_obj_path, options = message
+            self._apply_attached(dev_class, dev_str, vm_obj_path, options)
+        elif kind == 'detach':
+            _, dev_class, dev_str, vm_obj_path = message
+            self._apply_detached(dev_class, dev_str, vm_obj_path)
+        else:
+            log.error('Unknown worker message %s', kind)
+
+    @dbus.service.method(SERVICE_NAME, out_signature="u",
+                         async_callbacks=('reply_handler', 'error_handler'))
+    def Verify(self, reply_handler, error_handler):
+        ''' Verify the exported devices against qubesd now, returns the
+            number of repaired devices.
+        '''
+        qubesdbus.service.reply_future(self.verify(), reply_handler,
+                                       error_handler)
+
+    def _register_device(self, backend_name, obj_path, data):
+        ''' Export a new `Device` and add it to the indexes '''
+        device = Device(self.bus_name, obj_path, data, app=self.app,
+                        domain_index=self.domain_index,
+                        backend_name=backend_name)
+        device.journal = self.journal
+        self.devices[obj_path] = device
+        self.device_ids[(backend_name, data['dev_class'],
+                         str(data['ident']))] = obj_path
+        if data.get('frontend_domain'):
+            self.frontend_devices.setdefault(data['frontend_domain'],
+                                             set()).add(obj_path)
+        return device
+
+    def _unregister_device(self, backend_name, obj_path):
+        ''' Remove a `Device` from the bus and from the indexes '''
+        device = self.devices.pop(obj_path)
+        del self.device_ids[(backend_name, device.properties['dev_class'],
+                             str(device.name))]
+        frontend = device.properties.get('frontend_domain')
+        if frontend:
+            self._unindex_frontend(frontend, obj_path)
+        device.remove_from_connection()
+
+    def _unindex_frontend(self, frontend, obj_path):
+        try:
+            paths = self.frontend_devices[frontend]
+            paths.discard(obj_path)
+            if not paths:
+                del self.frontend_devices[frontend]
+        except KeyError:
+            pass
 
     def _device_attached(self, vm, event, device=None, options={}):
         if device is None:
             return
-        dev_str = device
-        device = None
-
-        qid = str(vm.qid)
-        vm_obj_path = dbus.ObjectPath(
-            os.path.join('/org/qubes/DomainManager1/domains', qid))
         dev_class = event.split(':', 1)[1]
+        self._apply_attached(dev_class, device,
+                             qubesdbus.serialize.domain_path(vm), options)
+
+    def _apply_attached(self, dev_class, dev_str, vm_obj_path, options):
         device = self._find_device(dev_class, dev_str)
+        obj_path = device._object_path  # pylint: disable=protected-access
+
+        old_frontend = device.properties.get('frontend_domain')
+        if old_frontend:
+            self._unindex_frontend(old_frontend, obj_path)
+        self.frontend_devices.setdefault(vm_obj_path, set()).add(obj_path)
 
-        changed_properties = []
-        device.properties['frontend_domain'] = dbus.ObjectPath(vm_obj_path)
+        device.properties['frontend_domain'] = vm_obj_path
         device.properties['attach_options'] = options
         changed_properties = {
             'frontend_domain': vm_obj_path,
             'attach_options': options
         }
-        invalidated_properties = []
-        device.PropertiesChanged(DEV_IFACE, changed_properties,
-                                 invalidated_properties)
-        device.Attached(vm_obj_path)
+        device.properties_changed(changed_properties)
+        device.queue_signal(device.Attached, vm_obj_path)
+        device.queue_signal(self.DeviceAttached, vm_obj_path, obj_path)
 
     def _device_detached(self, vm, event, device=None):
         if device is None:
             return
-
-        dev_str = device
-        device = None
-
-        qid = str(vm.qid)
-        vm_obj_path = dbus.ObjectPath(
-            os.path.join('/org/qubes/DomainManager1/domains', qid))
         dev_class = event.split(':', 1)[1]
+        self._apply_detached(dev_class, device,
+                             qubesdbus.serialize.domain_path(vm))
+
+    def _apply_detached(self, dev_class, dev_str, vm_obj_path):
         device = self._find_device(dev_class, dev_str)
-        del device.properties['frontend_domain']
-        try:
-            del device.properties['attach_options']
-        except KeyError:
-            pass
+        obj_path = device._object_path  # pylint: disable=protected-access
+        self._unindex_frontend(vm_obj_path, obj_path)
+        device.properties.pop('frontend_domain', None)
+        device.properties.pop('attach_options', None)
 
-        changed_properties = {}
-        invalidated_properties = ['frontend_domain', 'attach_options']
-        device.PropertiesChanged(DEV_IFACE, changed_properties,
-                                 invalidated_properties)
-        device.Detached(vm_obj_path)
+        device.properties_changed({}, ['frontend_domain', 'attach_options'])
+        device.queue_signal(device.Detached, vm_obj_path)
+        device.queue_signal(self.DeviceDetached, vm_obj_path, obj_path)
 
     def _find_device(self, dev_class, dev_str):
         vm_name, ident = dev_str.split(':', 1)
-        vm = self.app.domains[vm_name]
-        obj_path = device_path(vm, dev_class, ident)
-        return self.devices[obj_path]
-
-    def _frontend_domain(self, vm, assignment, dev_class):
-        backend_domain = assignment.backend_domain
-        ident = assignment.ident
-        obj_path = device_path(backend_domain, dev_class, ident)
-        try:
-            backend_obj_path = self.devices[obj_path].Get(
-                None, 'backend_domain')
-            frontend_obj_path = os.path.join(
-                os.path.dirname(backend_obj_path), str(vm.qid))
-            return (obj_path, frontend_obj_path)
-        except KeyError:
-            return None  # remove this when #1082 is fixed
+        return self.devices[self.device_ids[(vm_name, dev_class, ident)]]
+
+    @dbus.service.method(SERVICE_NAME, in_signature="t",
+                         out_signature="tba{oa{sv}}a{oas}ao")
+    def GetChangesSince(self, generation):
+        ''' Returns the current generation and the devices changed since
+            `generation`: `(generation, full, changed, invalidated, removed)`.
+            When `full` is true the generation aged out and `changed` holds a
+            full snapshot of all devices.
+        '''
+        return self.journal.changes_since(generation, self.devices)
+
+    @dbus.service.method(SERVICE_NAME, in_signature="o", out_signature="ao")
+    def GetAttachedDevices(self, vm_obj_path):
+        ''' Returns the object paths of all devices attached to the domain
+            `vm_obj_path`
+        '''
+        return dbus.Array(sorted(self.frontend_devices.get(vm_obj_path, ())),
+                          signature='o')
+
+    @dbus.service.method(SERVICE_NAME, in_signature="a(ooa{sv})",
+                         out_signature="as",
+                         async_callbacks=('reply_handler', 'error_handler'))
+    def AttachMany(self, assignments, reply_handler, error_handler):
+        ''' Attach multiple devices, each given as a `(device, frontend domain,
+            options)` tuple. The devices are attached in order, returns an
+            error message for each assignment, empty on success.
+        '''
+        jobs = []
+        for obj_path, vm_obj_path, options in assignments:
+            try:
+                device = self.devices[obj_path]
+            except KeyError:
+                jobs.append(None)
+                continue
+            jobs.append(functools.partial(device.attach, vm_obj_path, options))
+
+        def attach_all():
+            errors = []
+            for job in jobs:
+                if job is None:
+                    errors.append('No such device')
+                    continue
+                try:
+                    job()
+                    errors.append('')
+                except Exception as e:  # pylint: disable=broad-except
+                    errors.append(str(e) or type(e).__name__)
+            return dbus.Array(errors, signature='s')
+
+        qubesdbus.service.reply_async(attach_all, reply_handler,
+                                      error_handler)
+
+    @dbus.service.signal(SERVICE_NAME, signature="oo")
+    def DeviceAttached(self, vm_obj_path, obj_path):
+        ''' Emitted when device `obj_path` is attached to domain `vm_obj_path`
+        '''
+
+    @dbus.service.signal(SERVICE_NAME, signature="oo")
+    def DeviceDetached(self, vm_obj_path, obj_path):
+        ''' Emitted when device `obj_path` is detached from domain
+            `vm_obj_path`
+        '''
 
     @dbus.service.signal(SERVICE_NAME, signature="o")
     def Removed(self, obj_path):
@@ -208,11 +538,64 @@ class DeviceManager(qubesdbus.service.ObjectManager):
 class Device(qubesdbus.service.PropertiesObject):
     ''' A D-Bus proxy for a device '''
 
-    def __init__(self, bus_name, obj_path, data):
+    def __init__(self, bus_name, obj_path, data, app=None,
+                 backend_name=None, domain_index=None):
         self.properties = data
         self.name = data['ident']
+        self.backend_name = backend_name
+        self.domain_index = domain_index
+        if app is not None:
+            self.app = app
         super().__init__(bus_name, obj_path, DEV_IFACE, data)
 
+    def _assignment(self, options=None, persistent=False):
+        backend = self.app.domains[self.backend_name]
+        return qubesadmin.devices.DeviceAssignment(
+            backend, str(self.name), options=options, persistent=persistent)
+
+    def attach(self, vm_obj_path, options):
+        ''' Attach the device to the domain `vm_obj_path`. Blocking, called
+            from the executor.
+        '''
+        options = dict(options)
+        persistent = bool(options.pop('persistent', False))
+        options = {str(k): str(v) for k, v in options.items()}
+        frontend = self.domain_index.find(vm_obj_path)
+        dev_class = str(self.properties['dev_class'])
+        frontend.devices[dev_class].attach(
+            self._assignment(options, persistent))
+
+    def detach(self):
+        ''' Detach the device from its frontend domain. Blocking, called
+            from the executor.
+        '''
+        try:
+            vm_obj_path = self.properties['frontend_domain']
+        except KeyError:
+            raise dbus.DBusException("Device %s is not attached" % self.name,
+                                     name="NotAttached")
+        frontend = self.domain_index.find(vm_obj_path)
+        dev_class = str(self.properties['dev_class'])
+        frontend.devices[dev_class].detach(self._assignment())
+
+    @dbus.service.method(DEV_IFACE, in_signature="oa{sv}",
+                         async_callbacks=('reply_handler', 'error_handler'))
+    def Attach(self, vm_obj_path, options, reply_handler, error_handler):
+        ''' Attach the device to the domain `vm_obj_path`. The option
+            `persistent` makes the assignment persistent, all other options
+            are passed to the device backend.
+        '''
+        qubesdbus.service.reply_async(
+            functools.partial(self.attach, vm_obj_path, options),
+            reply_handler, error_handler)
+
+    @dbus.service.method(DEV_IFACE,
+                         async_callbacks=('reply_handler', 'error_handler'))
+    def Detach(self, reply_handler, error_handler):
+        ''' Detach the device from its frontend domain '''
+        qubesdbus.service.reply_async(self.detach, reply_handler,
+                                      error_handler)
+
     @dbus.service.signal(DEV_IFACE, signature="o")
     def Attached(self, vm_obj_path):
         # type: (dbus.ObjectPath) -> None
@@ -224,18 +607,176 @@ class Device(qubesdbus.service.PropertiesObject):
         ''' Signal emitted when the device is detached from domain.'''
 
 
+def build_topology(app, dev_classes, qids=None):
+    ''' Gather the available and attached devices of `dev_classes` of all
+        domains in a single pass, querying the domains concurrently.
+        Returns a mapping of device object path to `(backend name, device
+        data)`, with the frontend domain and attach options already set.
+        The dictionary `qids`, if given, is filled with the domain name →
+        qid mapping.
+    '''
+    if qids is None:
+        qids = {}
+    domains = list(app.domains)
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=TOPOLOGY_WORKERS) as executor:
+        qids.update(executor.map(lambda vm: (vm.name, vm.qid), domains))
+        results = executor.map(
+            lambda vm: domain_topology(vm, qids, dev_classes), domains)
+
+        devices = collections.OrderedDict()
+        frontends = {}
+        for domain_devices, domain_frontends in results:
+            devices.update(domain_devices)
+            frontends.update(domain_frontends)
+
+    for obj_path, (vm_obj_path, options) in frontends.items():
+        try:
+            data = devices[obj_path][1]
+        except KeyError:
+            continue
+        data['frontend_domain'] = vm_obj_path
+        if options:
+            data['attach_options'] = options
+    return devices
+
+
+def domain_topology(vm, qids, dev_classes):
+    ''' Collect available and attached devices of a single domain '''
+    devices = []
+    frontends = []
+    vm_obj_path = qubesdbus.serialize.domain_path(vm, qids[vm.name])
+    for dev_class in dev_classes:
+        collection = vm.devices[dev_class]
+        for dev_info in collection.available():
+            data = qubesdbus.serialize.device_data(dev_info)
+            data['dev_class'] = dev_class
+            obj_path = _device_path(qids[vm.name], dev_class,
+                                    data['ident'])
+            devices.append((obj_path, (vm.name, data)))
+        for assignment in collection.attached():
+            try:
+                backend_qid = qids[assignment.backend_domain.name]
+            except KeyError:
+                continue
+            obj_path = _device_path(backend_qid, dev_class,
+                                    assignment.ident)
+            frontends.append((obj_path, (vm_obj_path,
+                                         assignment.options)))
+    return devices, frontends
+
+
+def device_list(vm, dev_class):
+    ''' Returns the available `dev_class` devices of `vm` as a list of
+        `(object path, device data)`
+    '''
+    entries = []
+    for dev_info in vm.devices[dev_class].available():
+        data = qubesdbus.serialize.device_data(dev_info)
+        data['dev_class'] = dev_class
+        entries.append((device_path(vm, dev_class, dev_info.ident), data))
+    return entries
+
+
+class DomainIndex(object):
+    ''' Maps domain qids to names, so the domain of an object path is found
+        without reading the qid of every domain. A missing or stale entry
+        rebuilds the map.
+    '''
+
+    def __init__(self, app) -> None:
+        self.app = app
+        self.names = {}  # type: Dict[int, str]
+
+    def update(self, qids) -> None:
+        ''' Replace the map with `qids`, a domain name → qid mapping '''
+        self.names = {qid: name for name, qid in qids.items()}
+
+    def add(self, vm) -> None:
+        self.names[vm.qid] = vm.name
+
+    def remove(self, name) -> None:
+        for qid, known in list(self.names.items()):
+            if known == name:
+                del self.names[qid]
+
+    def find(self, vm_obj_path):
+        ''' Returns the `qubesadmin.vm.QubesVM` for a domain object path '''
+        qid = int(os.path.basename(vm_obj_path))
+        name = self.names.get(qid)
+        if name is None or name not in self.app.domains:
+            self.names = {vm.qid: vm.name for vm in self.app.domains}
+            name = self.names.get(qid)
+        if name is None:
+            raise dbus.DBusException("No domain with path %s" % vm_obj_path,
+                                     name="UnknownObject")
+        return self.app.domains[name]
+
+
 def device_path(vm, dev_class, ident):
+    return _device_path(vm.qid, dev_class, ident)
+
+
+def _device_path(qid, dev_class, ident):
     _id = re.sub(r"[^A-Za-z0-9_/]", "_", ident)
-    return os.path.join(SERVICE_PATH, dev_class, str(vm.qid), _id)
+    return os.path.join(SERVICE_PATH, dev_class, str(qid), _id)
+
+
+parser = argparse.ArgumentParser(description=__doc__)
+qubesdbus.service.add_arguments(parser, 'device')
+parser.add_argument('--sharded', action='store_true',
+                    help='handle every device class in a separate worker '
+                    'process')
 
 
-def main(args=None):  # pylint: disable=unused-argument
+def main(args=None):
     ''' Main function starting the DomainManager1 service. '''
-    manager = DeviceManager()
+    started = time.monotonic()
+    args = parser.parse_args(args)
+    qubesdbus.service.setup_loop()
+    checkpoint = qubesdbus.service.read_checkpoint(SERVICE_NAME)
+    manager = DeviceManager(sharded=args.sharded, checkpoint=checkpoint)
+    qubesdbus.service.report_startup(SERVICE_NAME, started,
+                                     checkpoint is not None)
     loop = asyncio.get_event_loop()
-    loop.run_until_complete(manager.run())
-    loop.stop()
-    loop.run_forever()
+    tasks = []
+    if checkpoint is not None:
+        tasks.append(asyncio.ensure_future(manager.catch_up()))
+    exporter = None
+    if args.export_socket:
+        exporter = qubesdbus.export.StateExporter(
+            args.export_socket, manager.journal, lambda: manager.devices)
+        loop.run_until_complete(exporter.start())
+    if args.verify_interval:
+        tasks.append(asyncio.ensure_future(
+            qubesdbus.service.verify_periodically(manager,
+                                                  args.verify_interval)))
+    idle_task = None
+    if args.idle_timeout:
+        idle = qubesdbus.service.IdleMonitor(manager.bus, args.idle_timeout)
+        idle.busy.append(lambda: manager.subscriptions.clients)
+        if exporter is not None:
+            idle.busy.append(lambda: exporter.clients)
+        idle_task = asyncio.ensure_future(idle.run())
+        idle_task.add_done_callback(lambda _: loop.stop())
+        tasks.append(idle_task)
+    if args.sharded:  # the workers listen for the events
+        loop.run_forever()
+    else:
+        run_task = asyncio.ensure_future(manager.run())
+        run_task.add_done_callback(lambda _: loop.stop())
+        tasks.append(run_task)
+        loop.run_forever()
+        if run_task.done():
+            # raise an exception, if any
+            run_task.result()
+    if idle_task is not None and idle_task.done():
+        # the daemonic workers are terminated on exit
+        manager.checkpoint()
+        manager.bus.release_name(SERVICE_NAME)
+    qubesdbus.service.cancel_tasks(tasks)
+    if exporter is not None:
+        loop.run_until_complete(exporter.stop())
     loop.close()
     return 0
 
@@ -0,0 +1,102 @@
+# -*- encoding: utf-8 -*-
+#
+# The Qubes OS Project, https://www.qubes-os.org/
+#
+# Copyright (C) 2016 Bahtiar `kalkin-` Gadimov <bahtiar@gadimov.de>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+''' Worker process of the sharded `org.qubes.Devices1` service.
+
+Every worker handles a single device class. It talks to qubesd and pushes
+updates to the front process owning the bus name, over a
+`multiprocessing` pipe:
+
+* `('snapshot', dev_class, [(obj_path, (backend_name, data)), …])`
+* `('list', backend_name, qid, dev_class, [(obj_path, data), …])`
+* `('attach', dev_class, 'backend:ident', frontend_path, options)`
+* `('detach', dev_class, 'backend:ident', frontend_path)`
+
+The front process may send `('verify',)` to request a new snapshot.
+'''
+
+import asyncio
+import logging
+
+import qubesadmin
+from qubesadmin.events import EventsDispatcher
+
+import qubesdbus.serialize
+from qubesdbus.service import to_plain
+
+log = logging.getLogger('qubesdbus.device_shard')
+
+
+def worker(dev_class: str, conn) -> None:
+    ''' Entry point of the worker process handling `dev_class` devices '''
+    # imported here, the worker is started with the `spawn` method
+    import qubesdbus.device_manager as device_manager
+
+    app = qubesadmin.Qubes()
+    dispatcher = EventsDispatcher(app)
+    connected = [False]
+
+    def send(*message):
+        conn.send(to_plain(message))
+
+    def snapshot():
+        devices = device_manager.build_topology(app, [dev_class])
+        send('snapshot', dev_class, list(devices.items()))
+
+    def list_changed(vm, _, **__):
+        send('list', vm.name, vm.qid, dev_class,
+             device_manager.device_list(vm, dev_class))
+
+    def attached(vm, _, device=None, options=None, **__):
+        if device is not None:
+            send('attach', dev_class, device,
+                 qubesdbus.serialize.domain_path(vm), options or {})
+
+    def detached(vm, _, device=None, **__):
+        if device is not None:
+            send('detach', dev_class, device,
+                 qubesdbus.serialize.domain_path(vm))
+
+    def connection_established(*_, **__):
+        if connected[0]:  # reconnected, events may have been missed
+            snapshot()
+        connected[0] = True
+
+    def command():
+        try:
+            message = conn.recv()
+        except EOFError:  # the front process is gone
+            loop.stop()
+            return
+        if message[0] == 'verify':
+            snapshot()
+
+    dispatcher.add_handler('device-list-change:%s' % dev_class, list_changed)
+    dispatcher.add_handler('device-attach:%s' % dev_class, attached)
+    dispatcher.add_handler('device-detach:%s' % dev_class, detached)
+    dispatcher.add_handler('connection-established', connection_established)
+
+    snapshot()
+    loop = asyncio.get_event_loop()
+    loop.add_reader(conn.fileno(), command)
+    try:
+        loop.run_until_complete(dispatcher.listen_for_events())
+    except RuntimeError:  # stopped by command()
+        pass
+    loop.close()
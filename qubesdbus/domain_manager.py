@@ -19,19 +19,26 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 ''' org.qubes.DomainManager1 Service '''
 
+import argparse
+import array
 import asyncio
 import logging
 import sys
-from typing import Any, Dict, List, Union  # pylint: disable=unused-import
+import time
+from typing import Any, Dict, List, Set, Union  # pylint: disable=unused-import
 
 import dbus
 import dbus.service
 from systemd.journal import JournalHandler
 
 import qubesadmin
+import qubesdbus.debug
+import qubesdbus.export
 import qubesdbus.serialize
-from qubesdbus.models import Domain
-from qubesdbus.service import PropertiesObject
+import qubesdbus.service
+from qubesdbus.models import Domain, DomainState, valid_state_change
+from qubesdbus.service import (EventQueue, ManagerObject, PropertiesObject,
+                               Subscriptions)
 from qubesadmin.events import EventsDispatcher
 
 log = logging.getLogger('qubesdbus.DomainManager1')
@@ -39,16 +46,153 @@ log.addHandler(JournalHandler(level=logging.DEBUG, SYSLOG_IDENTIFIER='qubesdbus.
 log.propagate = True
 
 # type aliases
-DBusSignalMatch = dbus.connection.SignalMatch
 DBusString = Union[str, dbus.String]
 DBusProperties = Dict[DBusString, Any]
 
 SERVICE_NAME = 'org.qubes.DomainManager1'
 SERVICE_PATH = '/org/qubes/DomainManager1'
 INTERFACE = 'org.qubes.DomainManager1'
+DOMAINS_PATH = SERVICE_PATH + '/domains/'
 
+# number of `vm-stats` samples kept per domain
+STATS_HISTORY_SIZE = 300
 
-class DomainManager(PropertiesObject):
+
+class StatsHistory(object):
+    ''' Fixed size ring buffer of `vm-stats` samples for a single domain.
+
+        Samples are stored in preallocated arrays, so adding a sample never
+        allocates. `cpu_usage` is derived from the `cpu_time` delta when
+        qubesd does not provide it and the memory trend (KiB/s over the
+        buffered window) is updated on every sample.
+    '''
+
+    def __init__(self, size: int = STATS_HISTORY_SIZE) -> None:
+        self.size = size
+        self.timestamps = array.array('d', [0.0] * size)
+        self.memory = array.array('q', [0] * size)
+        self.cpu_time = array.array('q', [0] * size)
+        self.cpu_usage = array.array('d', [0.0] * size)
+        self.count = 0
+        self.head = 0  # index of the next slot to write
+        self.memory_trend = 0.0
+
+    def add(self, timestamp: float, memory_kb: int, cpu_time: int,
+            cpu_usage: float = None) -> float:
+        ''' Add a sample and return the cpu usage (in percent) for it.
+
+            `cpu_time` is the total cpu time of the domain in milliseconds, as
+            reported by `admin.vm.Stats`.
+        '''
+        if cpu_usage is None:
+            cpu_usage = 0.0
+            if self.count:
+                last = (self.head - 1) % self.size
+                delta_t = timestamp - self.timestamps[last]
+                delta_cpu = cpu_time - self.cpu_time[last]
+                if delta_t > 0 and delta_cpu >= 0:
+                    cpu_usage = delta_cpu / (delta_t * 10.0)
+
+        idx = self.head
+        self.timestamps[idx] = timestamp
+        self.memory[idx] = memory_kb
+        self.cpu_time[idx] = cpu_time
+        self.cpu_usage[idx] = cpu_usage
+        self.head = (idx + 1) % self.size
+        if self.count < self.size:
+            self.count += 1
+
+        oldest = (self.head - self.count) % self.size
+        delta_t = timestamp - self.timestamps[oldest]
+        if delta_t > 0:
+            self.memory_trend = (memory_kb - self.memory[oldest]) / delta_t
+        else:
+            self.memory_trend = 0.0
+        return cpu_usage
+
+    def since(self, timestamp: float) -> List[tuple]:
+        ''' Return `(timestamp, memory_kb, cpu_usage)` samples newer than
+            `timestamp`, oldest first.
+        '''
+        result = []
+        for i in range(self.count):
+            idx = (self.head - self.count + i) % self.size
+            if self.timestamps[idx] >= timestamp:
+                result.append((self.timestamps[idx], self.memory[idx],
+                               self.cpu_usage[idx]))
+        return result
+
+
+class DependencyIndex(object):
+    ''' Reverse index of the references between domains. Every domain
+        property holding a domain path (`netvm`, `template`,
+        `default_dispvm`, …) is a relation named after the property.
+    '''
+
+    def __init__(self) -> None:
+        # domain path → {relation → referenced domain path}
+        self.forward = {}  # type: Dict[str, Dict[str, str]]
+        # relation → {referenced domain path → referencing domain paths}
+        self.reverse = {}  # type: Dict[str, Dict[str, Set[str]]]
+
+    def update(self, obj_path: str, properties: DBusProperties) -> None:
+        ''' (Re)index the references of domain `obj_path` '''
+        self.remove(obj_path)
+        references = {
+            str(name): str(value)
+            for name, value in properties.items()
+            if isinstance(value, dbus.ObjectPath)
+            and value.startswith(DOMAINS_PATH)
+        }
+        self.forward[obj_path] = references
+        for relation, target in references.items():
+            self.reverse.setdefault(relation, {}).setdefault(
+                target, set()).add(obj_path)
+
+    def remove(self, obj_path: str) -> None:
+        ''' Drop the references of domain `obj_path` '''
+        for relation, target in self.forward.pop(obj_path, {}).items():
+            sources = self.reverse[relation][target]
+            sources.discard(obj_path)
+            if not sources:
+                del self.reverse[relation][target]
+
+    def dependents(self, obj_path: str, relation: str = '') -> Set[str]:
+        ''' Domains referencing `obj_path`, through `relation` or through any
+            relation if it is empty.
+        '''
+        if relation:
+            return set(self.reverse.get(relation, {}).get(obj_path, ()))
+        result = set()  # type: Set[str]
+        for targets in self.reverse.values():
+            result.update(targets.get(obj_path, ()))
+        return result
+
+    def shutdown_order(self, obj_paths) -> List[str]:
+        ''' The domains `obj_paths` and all domains transitively depending on
+            them, ordered so that every domain comes before the domains it
+            depends on. Reversed it is a valid start order.
+        '''
+        result = []  # type: List[str]
+        done = set()  # type: Set[str]
+        visiting = set()  # type: Set[str]
+
+        def visit(obj_path):
+            if obj_path in done or obj_path in visiting:
+                return  # already ordered or a reference cycle
+            visiting.add(obj_path)
+            for dependent in sorted(self.dependents(obj_path)):
+                visit(dependent)
+            visiting.discard(obj_path)
+            done.add(obj_path)
+            result.append(obj_path)
+
+        for obj_path in obj_paths:
+            visit(str(obj_path))
+        return result
+
+
+class DomainManager(PropertiesObject, ManagerObject):
     ''' The `DomainManager` is the equivalent to the `qubes.Qubes` object for
         managing domains. Implements:
             * `org.freedesktop.DBus.ObjectManager` interface for acquiring all the
@@ -57,9 +201,12 @@ class DomainManager(PropertiesObject):
                properties
     '''
 
-    def __init__(self) -> None:
+    def __init__(self, checkpoint=None) -> None:
         self.app = qubesadmin.Qubes()
-        qubes_data = qubesdbus.serialize.qubes_data(self.app)  # type: DBusProperties
+        if checkpoint is None:
+            qubes_data = qubesdbus.serialize.qubes_data(self.app)  # type: DBusProperties
+        else:
+            qubes_data = checkpoint['state']
         bus = dbus.SessionBus()
         bus_name = dbus.service.BusName(SERVICE_NAME, bus=bus,
                                         allow_replacement=True,
@@ -67,7 +214,6 @@ class DomainManager(PropertiesObject):
         super().__init__(bus_name, SERVICE_PATH, INTERFACE, qubes_data)
         self.bus_name = bus_name
         self.bus = bus
-        self.signal_matches = {}  # type: Dict[str, List[DBusSignalMatch]]
         self.state_signals = {
             'Starting': self.Starting,
             'Started': self.Started,
@@ -76,121 +222,292 @@ class DomainManager(PropertiesObject):
             'Halted': self.Halted,
             'Unknown': lambda _, __: None,
         }
-
-        self.domains = {
-            vm.name: self._proxify_domain(vm)
-            for vm in self.app.domains
-        }
-        self.events_dispatcher.add_handler('domain-add', self._domain_add)
-        self.events_dispatcher.add_handler('domain-delete',
-                                           self._domain_delete)
-        self.events_dispatcher.add_handler('domain-spawn', self._domain_spawn)
-        self.events_dispatcher.add_handler('domain-start', self._domain_start)
-        self.events_dispatcher.add_handler('domain-pre-shutdown',
-                                           self._domain_pre_shutdown)
-        self.events_dispatcher.add_handler('domain-shutdown',
-                                           self._domain_shutdown)
+        # separate client for the verification running in the executor
+        self.verify_app = qubesadmin.Qubes()
+        # domain object path → StatsHistory
+        self.stats_history = {}  # type: Dict[str, StatsHistory]
+        self.domain_paths = set()  # type: Set[str]
+        self.journal = qubesdbus.service.ChangeJournal()
+        self.debug = qubesdbus.debug.Debug(bus_name, SERVICE_PATH)
+        self.subscriptions = Subscriptions(self)
+        self.dependencies = DependencyIndex()
+        self.connected = False
+        self.repaired = 0
+
+        if checkpoint is None:
+            self.domains = {
+                vm.name: self._proxify_domain(vm)
+                for vm in self.app.domains
+            }
+        else:  # refreshed by catch_up()
+            self.domains = {
+                str(data['name']): self._export_domain(data)
+                for data in checkpoint['objects'].values()
+            }
+        self.events_queue = EventQueue()
+        self.add_event_handler('domain-add', self._domain_add)
+        self.add_event_handler('domain-delete', self._domain_delete)
+        self.add_event_handler('domain-spawn', self._domain_spawn)
+        self.add_event_handler('domain-start', self._domain_start)
+        self.add_event_handler('domain-pre-shutdown',
+                               self._domain_pre_shutdown)
+        self.add_event_handler('domain-shutdown', self._domain_shutdown)
+        self.add_event_handler('property-set:*', self._property_changed)
+        self.add_event_handler('property-del:*', self._property_changed)
+        self.add_event_handler('connection-established',
+                               self._connection_established)
         self.stats_dispatcher = EventsDispatcher(self.app, api_method='admin.vm.Stats')
-        self.stats_dispatcher.add_handler('vm-stats', self._update_stats)
+        self.add_event_handler('vm-stats', self._update_stats,
+                               self.stats_dispatcher, timestamped=True)
 
     def _domain_add(self, _, __, **kwargs):
-        vm_name = kwargs['vm']
-        vm = self.app.domains[vm_name]
+        vm = self.app.domains[kwargs['vm']]
+        self._add_domain(qubesdbus.serialize.domain_data(vm))
+        return True
+
+    def _add_domain(self, data) -> None:
+        vm_name = str(data['name'])
         log.info('Added domain %s', vm_name)
-        vm_proxy = self._proxify_domain(vm)
+        vm_proxy = self._export_domain(data)
         obj_path = vm_proxy._object_path # pylint: disable=protected-access
         self.domains[vm_name] = vm_proxy
+        self.journal.record(obj_path, 'added')
         self.DomainAdded(INTERFACE, obj_path)
-        return True
 
     def _domain_delete(self, _, __, **kwargs):
         vm_name = kwargs['vm']
         try:
             vm_proxy = self.domains[vm_name]
             obj_path = vm_proxy._object_path # pylint: disable=protected-access
-            for signal_matcher in self.signal_matches[obj_path]:
-                signal_matcher.remove()
             vm_proxy.remove_from_connection()
             del self.domains[vm_name]
+            self.domain_paths.discard(obj_path)
+            self.stats_history.pop(obj_path, None)
+            self.dependencies.remove(obj_path)
+            self.journal.record(obj_path, 'removed')
             self.DomainRemoved(INTERFACE, obj_path)
             return True
         except KeyError:
             return False
 
-    def _domain_spawn(self, vm, _, **__):
+    def _connection_established(self, *_, **__):
+        if self.connected:  # reconnected, events may have been missed
+            asyncio.ensure_future(self.verify(full=True))
+        self.connected = True
+
+    def _power_states(self) -> Dict[str, str]:
+        ''' Returns the serialized power state of every domain. Blocking,
+            called from the executor.
+        '''
+        self.verify_app.domains.clear_cache()
+        return {
+            vm.name: qubesdbus.serialize.serialize_state(vm.get_power_state())
+            for vm in self.verify_app.domains
+        }
+
+    def _domains_data(self, names) -> Dict[str, DBusProperties]:
+        ''' Returns the properties of the domains `names`, leaving out the
+            ones which don't exist anymore. Blocking, called from the
+            executor.
+        '''
+        result = {}
+        for name in names:
+            try:
+                vm = self.verify_app.domains[name]
+                result[name] = qubesdbus.serialize.domain_data(vm)
+            except KeyError:
+                continue
+        return result
+
+    @asyncio.coroutine
+    def verify(self, full=False):
+        ''' Verify the exported domains against qubesd and repair the ones
+            which differ, emitting only the differences. The domain list and
+            power states are always compared. Without `full` the properties
+            are fetched just for domains which differ, with `full` the
+            property digests of all domains and the global properties are
+            compared as well. The data is gathered in the executor, with a
+            separate admin client. Returns the number of repaired domains.
+        '''
+        loop = asyncio.get_event_loop()
+        states = yield from loop.run_in_executor(None, self._power_states)
+        repaired = 0
+        for name in list(self.domains):
+            if name not in states:
+                self._domain_delete(None, None, vm=name)
+                repaired += 1
+
+        differ = [
+            name for name, state in states.items()
+            if full or name not in self.domains
+            or state != self.domains[name].properties.get('state')
+        ]
+        data = yield from loop.run_in_executor(None, self._domains_data,
+                                               differ)
+        self.app.domains.clear_cache()
+        for name, vm_data in data.items():
+            try:
+                vm_proxy = self.domains[name]
+            except KeyError:
+                self._add_domain(vm_data)
+                repaired += 1
+                continue
+            state = states[name]
+            changed = state != vm_proxy.properties.get('state')
+            if changed:
+                # qubesd knows the actual state, no need to ask it again
+                self._apply_state(vm_proxy, DomainState(state),
+                                  lambda state=state: state)
+            if vm_proxy.update_properties(vm_data):
+                # pylint: disable=protected-access
+                self.dependencies.update(vm_proxy._object_path,
+                                         vm_proxy.properties)
+                changed = True
+            if changed:
+                repaired += 1
+
+        if full:
+            qubes_data = yield from loop.run_in_executor(
+                None, qubesdbus.serialize.qubes_data, self.verify_app)
+            self.update_properties(qubes_data)
+
+        self.repaired += repaired
+        log.info('Verified %d domains%s, repaired %d', len(self.domains),
+                 ' and their properties' if full else '', repaired)
+        return repaired
+
+    @asyncio.coroutine
+    def catch_up(self):
+        ''' Refresh a state restored from a checkpoint with a full
+            verification
+        '''
+        yield from self.verify(full=True)
+        log.info('Caught up with qubesd')
+
+    def objects(self):
+        return {o._object_path: o  # pylint: disable=protected-access
+                for o in self.domains.values()}
+
+    def checkpoint(self) -> None:
+        ''' Write the exported state for a fast resume on the next start '''
+        qubesdbus.service.write_checkpoint(SERVICE_NAME, self.objects(),
+                                           self.properties)
+
+    def _property_changed(self, vm, event, **_):
+        ''' Event handler for `property-set:*` and `property-del:*` '''
+        if vm is None:  # global property
+            return
         try:
             vm_proxy = self.domains[vm.name]
-        except KeyError:  # just to be sure
-            vm_proxy = self._proxify_domain(vm)
-            self.domains[vm.name] = vm_proxy
-        vm_proxy.Set("org.freedesktop.DBus.Properties", 'state', 'Starting')
+        except KeyError:
+            return
+        name = event.split(':', 1)[1]
+        try:
+            value = qubesdbus.serialize.serialize_val(getattr(vm, name))
+        except AttributeError:
+            value = dbus.String('')
+        vm_proxy.Set("org.freedesktop.DBus.Properties", name, value)
+        # pylint: disable=protected-access
+        self.dependencies.update(vm_proxy._object_path, vm_proxy.properties)
+
+    def _domain_spawn(self, vm, _, **__):
+        self._set_state(vm, DomainState.STARTING)
 
     def _domain_start(self, vm, _, **__):
-        try:
-            vm_proxy = self.domains[vm.name]
-        except KeyError:  # just to be sure
-            vm_proxy = self._proxify_domain(vm)
-            self.domains[vm.name] = vm_proxy
-        vm_proxy.Set("org.freedesktop.DBus.Properties", 'state', 'Started')
+        self._set_state(vm, DomainState.STARTED)
 
     def _domain_pre_shutdown(self, vm, _, **__):
-        try:
-            vm_proxy = self.domains[vm.name]
-        except KeyError:  # just to be sure
-            vm_proxy = self._proxify_domain(vm)
-            self.domains[vm.name] = vm_proxy
-        vm_proxy.Set("org.freedesktop.DBus.Properties", 'state', 'Halting')
+        self._set_state(vm, DomainState.HALTING)
 
     def _domain_shutdown(self, vm, _, **__):
+        self._set_state(vm, DomainState.HALTED)
+
+    def _set_state(self, vm, state: DomainState) -> None:
+        ''' Apply a state transition observed from an event. If the transition
+            is not possible from the current state an event was missed, so the
+            state is resynchronised from `vm.get_power_state()` instead.
+        '''
         try:
             vm_proxy = self.domains[vm.name]
         except KeyError:  # just to be sure
             vm_proxy = self._proxify_domain(vm)
             self.domains[vm.name] = vm_proxy
-        vm_proxy.Set("org.freedesktop.DBus.Properties", 'state', 'Halted')
-
-    def _setup_state_signals(self, vm_proxy: Domain):
+        self._apply_state(
+            vm_proxy, state,
+            lambda: qubesdbus.serialize.serialize_state(vm.get_power_state()))
+
+    def _apply_state(self, vm_proxy: Domain, state: DomainState,
+                     actual_state) -> None:
+        ''' Move `vm_proxy` to `state` through `Domain.Set`, which validates
+            the transition and emits the state signal. For an impossible
+            transition the state is set to the one returned by
+            `actual_state()` instead.
+        '''
+        cur_state = vm_proxy.properties.get('state')
+        if cur_state != state.value \
+                and not valid_state_change(cur_state, state.value):
+            actual = actual_state()
+            log.warning('%s: impossible state change %s → %s, '
+                        'resynchronised to %s', vm_proxy.name, cur_state,
+                        state.value, actual)
+            if actual == cur_state:
+                return
+            # the signals up to the actual state were missed, go straight
+            # there without validating
+            state = DomainState(actual)
+            super(Domain, vm_proxy).Set("org.freedesktop.DBus.Properties",
+                                        'state', state.value)
+            self._emit_state_signal(vm_proxy, state.value)
+            return
+        vm_proxy.Set("org.freedesktop.DBus.Properties", 'state', state.value)
+
+    def _emit_state_signal(self, vm_proxy: Domain, state: str) -> None:
+        ''' Emit the state signal matching the new domain state, after the
+            `PropertiesChanged` carrying it. Called directly by `Domain.Set`
+            when the `state` property changes.
+        '''
         obj_path = vm_proxy._object_path  # pylint: disable=protected-access
-        def emit_state_signal(
-                dbus_interface,
-                changed_properties: DBusProperties,
-                invalidated: dbus.Array=None  # pylint: disable=unused-argument
-        ) -> None:
-            ''' Emit state signal when domain state property is changed. '''
-            #assert dbus_interface == 'org.freedesktop.DBus.Properties'
-            if 'state' in changed_properties:
-                state = changed_properties['state']
-                assert state in self.state_signals
-                signal_func = self.state_signals[state]
-                signal_func(INTERFACE, obj_path)
-
-        signal_match = self.bus.add_signal_receiver(
-            emit_state_signal, signal_name="PropertiesChanged",
-            dbus_interface='org.freedesktop.DBus.Properties',
-            path=obj_path)  # type: DBusSignalMatch
-
-        if obj_path not in self.signal_matches:
-            self.signal_matches[obj_path] = list()
-
-        self.signal_matches[obj_path] += [signal_match]
-
-    def _update_stats(self, vm, _, **kwargs):
+        signal_func = self.state_signals[state]
+        vm_proxy.queue_signal(signal_func, INTERFACE, obj_path)
+
+    def _update_stats(self, vm, _, received=None, **kwargs):
         try:
             vm_proxy = self.domains[vm.name]
         except KeyError:  # just to be sure
             vm_proxy = self._proxify_domain(vm)
             self.domains[vm.name] = vm_proxy
 
+        obj_path = vm_proxy._object_path  # pylint: disable=protected-access
+        try:
+            history = self.stats_history[obj_path]
+        except KeyError:
+            history = self.stats_history[obj_path] = StatsHistory()
+
+        memory_kb = int(kwargs.get('memory_kb', 0))
+        cpu_time = int(kwargs.get('cpu_time', 0))
+        cpu_usage = kwargs.get('cpu_usage')
+        if cpu_usage is not None:
+            cpu_usage = float(cpu_usage)
+        # the time of arrival, the sample may have waited in the queue
+        if received is None:
+            received = time.time()
+        cpu_usage = history.add(received, memory_kb, cpu_time, cpu_usage)
+
+        stats = {
+            'memory_usage': dbus.Int64(memory_kb),
+            'cpu_time': dbus.Int64(cpu_time),
+            'cpu_usage': dbus.Int64(round(cpu_usage)),
+            'memory_trend': dbus.Double(history.memory_trend),
+        }
         changed_properties = {}
-        for key, value in kwargs.items():
-            if key == 'memory_kb':
-                key = 'memory_usage'
-                value = int(value)
-            if vm_proxy.properties[key] != value:
+        for key, value in stats.items():
+            if vm_proxy.properties.get(key) != value:
                 vm_proxy.properties[key] = value
                 changed_properties[key] = value
 
-        vm_proxy.PropertiesChanged(Domain.INTERFACE, changed_properties, [])
+        if changed_properties:
+            # stats change every few seconds, keep them out of the journal
+            vm_proxy.properties_changed(changed_properties, record=False)
 
     @asyncio.coroutine
     def run_vm_stats(self):
@@ -207,6 +524,62 @@ class DomainManager(PropertiesObject):
             for o in self.domains.values()
         }
 
+    @dbus.service.method(INTERFACE, in_signature="t",
+                         out_signature="tba{oa{sv}}a{oas}ao")
+    def GetChangesSince(self, generation):
+        ''' Returns the current generation and the domains changed since
+            `generation`: `(generation, full, changed, invalidated, removed)`.
+            When `full` is true the generation aged out and `changed` holds a
+            full snapshot of all domains.
+        '''
+        return self.journal.changes_since(generation, self.objects())
+
+    @dbus.service.method(INTERFACE, out_signature="u",
+                         async_callbacks=('reply_handler', 'error_handler'))
+    def Verify(self, reply_handler, error_handler):
+        ''' Verify the exported domains and their properties against qubesd
+            now, returns the number of repaired domains.
+        '''
+        qubesdbus.service.reply_future(self.verify(full=True), reply_handler,
+                                       error_handler)
+
+    @dbus.service.method(INTERFACE, in_signature="os", out_signature="ao")
+    def GetDependents(self, obj_path, relation):
+        ''' Returns the domains referencing the domain `obj_path` through the
+            property `relation` (e.g. `netvm` or `template`), or through any
+            domain property if `relation` is empty.
+        '''
+        return dbus.Array(
+            sorted(self.dependencies.dependents(str(obj_path),
+                                                str(relation))),
+            signature='o')
+
+    @dbus.service.method(INTERFACE, in_signature="ao", out_signature="ao")
+    def GetShutdownOrder(self, obj_paths):
+        ''' Returns `obj_paths` and all domains depending on them, ordered so
+            each domain comes before the domains it depends on. The reversed
+            list is a valid start order.
+        '''
+        return dbus.Array(self.dependencies.shutdown_order(obj_paths),
+                          signature='o')
+
+    @dbus.service.method(INTERFACE, in_signature="ou",
+                         out_signature="a(dtd)")
+    def GetStatsHistory(self, obj_path, seconds):
+        ''' Returns the `(timestamp, memory_kb, cpu_usage)` samples of the last
+            `seconds` seconds for the domain at `obj_path`, oldest first.
+        '''
+        obj_path = str(obj_path)
+        if obj_path not in self.domain_paths:
+            raise dbus.DBusException("No domain with path %s" % obj_path,
+                                     name="UnknownObject")
+        try:
+            history = self.stats_history[obj_path]
+        except KeyError:
+            return dbus.Array([], signature='(dtd)')
+        return dbus.Array(history.since(time.time() - seconds),
+                          signature='(dtd)')
+
     @dbus.service.signal(INTERFACE, signature="so")
     def Started(self, interface, obj_path):
         # type: (DBusString, dbus.ObjectPath) -> None
@@ -244,26 +617,68 @@ class DomainManager(PropertiesObject):
         self.log.debug("Emiting DomainRemoved signal: %s", object_path)
 
     def _proxify_domain(self, vm):
+        return self._export_domain(qubesdbus.serialize.domain_data(vm))
+
+    def _export_domain(self, data):
         # type: (Dict[Union[str,DBusString], Any]) -> Domain
-        proxy = Domain(self.bus_name, SERVICE_PATH,
-                      qubesdbus.serialize.domain_data(vm))
-        self._setup_state_signals(proxy)
+        proxy = Domain(self.bus_name, SERVICE_PATH, data,
+                       state_changed=self._emit_state_signal)
+        proxy.journal = self.journal
+        # pylint: disable=protected-access
+        self.domain_paths.add(proxy._object_path)
+        self.dependencies.update(proxy._object_path, proxy.properties)
         return proxy
 
 
-def main(args=None):  # pylint: disable=unused-argument
+parser = argparse.ArgumentParser(description=__doc__)
+qubesdbus.service.add_arguments(parser, 'domain')
+
+
+def main(args=None):
     ''' Main function starting the DomainManager1 service. '''
+    started = time.monotonic()
+    args = parser.parse_args(args)
+    qubesdbus.service.setup_loop()
     loop = asyncio.get_event_loop()
-    manager = DomainManager()
+    checkpoint = qubesdbus.service.read_checkpoint(SERVICE_NAME)
+    manager = DomainManager(checkpoint)
+    qubesdbus.service.report_startup(SERVICE_NAME, started,
+                                     checkpoint is not None)
     tasks = [
         asyncio.ensure_future(manager.run()),
         asyncio.ensure_future(manager.run_vm_stats())
     ]
-    done, _ = loop.run_until_complete(asyncio.wait(tasks,
-        return_when=asyncio.FIRST_EXCEPTION))
+    background = []
+    if checkpoint is not None:
+        background.append(asyncio.ensure_future(manager.catch_up()))
+    if args.verify_interval:
+        tasks.append(asyncio.ensure_future(
+            qubesdbus.service.verify_periodically(manager,
+                                                  args.verify_interval)))
+    exporter = None
+    if args.export_socket:
+        exporter = qubesdbus.export.StateExporter(
+            args.export_socket, manager.journal, manager.objects)
+        loop.run_until_complete(exporter.start())
+    idle_task = None
+    if args.idle_timeout:
+        idle = qubesdbus.service.IdleMonitor(manager.bus, args.idle_timeout)
+        idle.busy.append(lambda: manager.subscriptions.clients)
+        if exporter is not None:
+            idle.busy.append(lambda: exporter.clients)
+        idle_task = asyncio.ensure_future(idle.run())
+        tasks.append(idle_task)
+    done, pending = loop.run_until_complete(asyncio.wait(tasks,
+        return_when=asyncio.FIRST_COMPLETED))
     for task in done:
         # raise an exception, if any
         task.result()
+    if idle_task in done:
+        manager.checkpoint()
+        manager.bus.release_name(SERVICE_NAME)
+    qubesdbus.service.cancel_tasks(list(pending) + background)
+    if exporter is not None:
+        loop.run_until_complete(exporter.stop())
     loop.close()
     return 0
 
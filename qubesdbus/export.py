@@ -0,0 +1,368 @@
+# -*- encoding: utf-8 -*-
+#
+# The Qubes OS Project, https://www.qubes-os.org/
+#
+# Copyright (C) 2016 Bahtiar `kalkin-` Gadimov <bahtiar@gadimov.de>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+''' Compact binary export of a manager's object state over a Unix socket.
+
+Every frame is a 4 byte big endian length followed by the payload. The first
+frame sent to a client is a full snapshot, all following frames are deltas:
+
+    payload  = kind:byte generation:varint changed invalidated removed
+    kind     = b'S' (snapshot, replaces the whole state) | b'D' (delta)
+    changed  = map of object path → map of property name → value
+    invalidated = map of object path → list of property names
+    removed  = list of object paths
+
+Values are encoded as a tag byte followed by the data, see `encode_value`.
+Use `StateReader` (or `python -m qubesdbus.export SOCKET`) to consume it.
+'''
+
+import asyncio
+import logging
+import os
+import struct
+import sys
+from typing import Any, Dict, List  # pylint: disable=unused-import
+
+import dbus
+
+log = logging.getLogger('qubesdbus.export')
+
+# clients with more than this many unsent bytes are disconnected
+MAX_CLIENT_BUFFER = 4 * 1024 * 1024
+
+_LENGTH = struct.Struct('>I')
+_DOUBLE = struct.Struct('>d')
+
+
+def _encode_varint(value: int, out: bytearray) -> None:
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _decode_varint(data: bytes, pos: int):
+    result = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+
+
+def _encode_str(value: str, out: bytearray) -> None:
+    data = value.encode('utf-8')
+    _encode_varint(len(data), out)
+    out += data
+
+
+def _decode_str(data: bytes, pos: int):
+    length, pos = _decode_varint(data, pos)
+    return data[pos:pos + length].decode('utf-8'), pos + length
+
+
+def encode_value(value, out: bytearray) -> None:
+    ''' Append the encoding of a D-Bus value to `out`.
+
+        * `T`, `F` — booleans
+        * `i` — integer as zigzag varint
+        * `d` — double
+        * `s` — string as varint length and utf-8 data
+        * `o` — object path, encoded like a string
+        * `y` — bytes as varint length and data
+        * `a` — array as varint count and values
+        * `m` — dictionary as varint count and string key, value pairs
+    '''
+    if isinstance(value, (bool, dbus.Boolean)):
+        out += b'T' if value else b'F'
+    elif isinstance(value, int):
+        out += b'i'
+        _encode_varint(value << 1 if value >= 0 else (-value << 1) - 1, out)
+    elif isinstance(value, float):
+        out += b'd'
+        out += _DOUBLE.pack(value)
+    elif isinstance(value, dbus.ObjectPath):
+        out += b'o'
+        _encode_str(value, out)
+    elif isinstance(value, str):
+        out += b's'
+        _encode_str(value, out)
+    elif isinstance(value, (bytes, bytearray)):
+        out += b'y'
+        _encode_varint(len(value), out)
+        out += value
+    elif isinstance(value, dict):
+        out += b'm'
+        _encode_varint(len(value), out)
+        for key, val in value.items():
+            _encode_str(str(key), out)
+            encode_value(val, out)
+    elif isinstance(value, (list, tuple)):
+        out += b'a'
+        _encode_varint(len(value), out)
+        for val in value:
+            encode_value(val, out)
+    else:
+        out += b's'
+        _encode_str(str(value), out)
+
+
+def decode_value(data: bytes, pos: int):
+    ''' Decode the value at `pos`, returns the value and the next position '''
+    # pylint: disable=too-many-return-statements
+    tag = data[pos:pos + 1]
+    pos += 1
+    if tag == b'T':
+        return True, pos
+    elif tag == b'F':
+        return False, pos
+    elif tag == b'i':
+        value, pos = _decode_varint(data, pos)
+        return (value >> 1) ^ -(value & 1), pos
+    elif tag == b'd':
+        return _DOUBLE.unpack_from(data, pos)[0], pos + _DOUBLE.size
+    elif tag == b's':
+        return _decode_str(data, pos)
+    elif tag == b'o':
+        value, pos = _decode_str(data, pos)
+        return dbus.ObjectPath(value), pos
+    elif tag == b'y':
+        length, pos = _decode_varint(data, pos)
+        return bytes(data[pos:pos + length]), pos + length
+    elif tag == b'm':
+        count, pos = _decode_varint(data, pos)
+        result = {}
+        for _ in range(count):
+            key, pos = _decode_str(data, pos)
+            result[key], pos = decode_value(data, pos)
+        return result, pos
+    elif tag == b'a':
+        count, pos = _decode_varint(data, pos)
+        result = []
+        for _ in range(count):
+            value, pos = decode_value(data, pos)
+            result.append(value)
+        return result, pos
+    raise ValueError('Unknown tag %r at %d' % (tag, pos - 1))
+
+
+def encode_frame(full: bool, generation: int, changed, invalidated,
+                 removed) -> bytes:
+    ''' Encode a `ChangeJournal.changes_since` result as a length prefixed
+        frame
+    '''
+    payload = bytearray(b'S' if full else b'D')
+    _encode_varint(generation, payload)
+    encode_value(changed, payload)
+    encode_value(invalidated, payload)
+    encode_value(removed, payload)
+    return _LENGTH.pack(len(payload)) + bytes(payload)
+
+
+class StateReader(object):
+    ''' Reference reader, reassembles the exported state from the stream.
+        `state` maps object paths to their properties.
+    '''
+
+    def __init__(self) -> None:
+        self.state = {}  # type: Dict[str, Dict[str, Any]]
+        self.generation = None  # type: int
+        self.buffer = b''
+
+    def feed(self, data: bytes) -> int:
+        ''' Feed received bytes, returns the number of applied frames '''
+        self.buffer += data
+        frames = 0
+        while len(self.buffer) >= _LENGTH.size:
+            length, = _LENGTH.unpack_from(self.buffer)
+            end = _LENGTH.size + length
+            if len(self.buffer) < end:
+                break
+            self.apply(self.buffer[_LENGTH.size:end])
+            self.buffer = self.buffer[end:]
+            frames += 1
+        return frames
+
+    def apply(self, payload: bytes) -> None:
+        ''' Apply a single frame payload to `state` '''
+        kind = payload[:1]
+        self.generation, pos = _decode_varint(payload, 1)
+        changed, pos = decode_value(payload, pos)
+        invalidated, pos = decode_value(payload, pos)
+        removed, pos = decode_value(payload, pos)
+        if kind == b'S':
+            self.state = changed
+            return
+        for obj_path, properties in changed.items():
+            self.state.setdefault(obj_path, {}).update(properties)
+        for obj_path, names in invalidated.items():
+            for name in names:
+                self.state.get(obj_path, {}).pop(name, None)
+        for obj_path in removed:
+            self.state.pop(obj_path, None)
+
+
+class StateExporter(object):
+    ''' Publishes the objects of a manager on a Unix socket. Changes are
+        taken from the manager's `ChangeJournal`, plus the property changes
+        kept out of it (like `vm-stats`) from
+        `qubesdbus.service.PROPERTIES_CHANGED`, and sent once per event loop
+        iteration.
+
+        :param journal: the manager's `qubesdbus.service.ChangeJournal`
+        :param objects: callable returning a mapping of object path to
+            `PropertiesObject`
+    '''
+
+    def __init__(self, socket_path: str, journal, objects) -> None:
+        self.socket_path = socket_path
+        self.journal = journal
+        self.objects = objects
+        self.clients = []  # type: List[asyncio.StreamWriter]
+        self.generation = journal.generation
+        self.scheduled = False
+        self.server = None
+        # object path → (changed properties, invalidated) not yet sent
+        self.pending = {}  # type: Dict[str, Any]
+        journal.listeners.append(self._journal_changed)
+        # imported here, qubesdbus.service imports this module
+        import qubesdbus.service
+        qubesdbus.service.PROPERTIES_CHANGED.listeners.append(
+            self._properties_changed)
+
+    @asyncio.coroutine
+    def start(self):
+        ''' Start listening on the socket '''
+        try:
+            os.unlink(self.socket_path)
+        except FileNotFoundError:
+            pass
+        self.server = yield from asyncio.start_unix_server(
+            self._client_connected, path=self.socket_path)
+        log.info('Exporting state on %s', self.socket_path)
+
+    @asyncio.coroutine
+    def stop(self):
+        ''' Stop listening and disconnect all clients '''
+        self.server.close()
+        for writer in self.clients:
+            writer.close()
+        self.clients = []
+        yield from self.server.wait_closed()
+        try:
+            os.unlink(self.socket_path)
+        except FileNotFoundError:
+            pass
+
+    @asyncio.coroutine
+    def _client_connected(self, reader, writer):
+        frame = encode_frame(*self._changes(0, self.objects()))
+        writer.write(frame)
+        if not self.clients:  # nothing was sent since the last client left
+            self.generation = self.journal.generation
+        self.clients.append(writer)
+        # the stream is write only, wait for the client to go away
+        yield from reader.read()
+        if writer in self.clients:
+            self.clients.remove(writer)
+        writer.close()
+
+    def _changes(self, generation, objects):
+        generation, full, changed, invalidated, removed = \
+            self.journal.changes_since(generation, objects)
+        return (full, generation, changed, invalidated, removed)
+
+    def _journal_changed(self, *_):
+        if not self.scheduled and self.clients:
+            asyncio.get_event_loop().call_soon(self.flush)
+            self.scheduled = True
+
+    def _properties_changed(self, obj, changed, invalidated) -> None:
+        if not self.clients:
+            return
+        # pylint: disable=protected-access
+        pending_changed, pending_invalid = self.pending.setdefault(
+            obj._object_path, ({}, set()))
+        pending_changed.update(changed)
+        pending_invalid.difference_update(changed)
+        for name in invalidated:
+            pending_changed.pop(name, None)
+            pending_invalid.add(name)
+        self._journal_changed()
+
+    def flush(self) -> None:
+        ''' Send the changes since the last flush to all clients '''
+        self.scheduled = False
+        pending, self.pending = self.pending, {}
+        if self.generation == self.journal.generation and not pending:
+            return
+        objects = self.objects()
+        full, generation, changed, invalidated, removed = self._changes(
+            self.generation, objects)
+        if not full:
+            for obj_path, (properties, invalid) in pending.items():
+                if obj_path not in objects:  # removed or not exported
+                    continue
+                merged = dict(changed.get(obj_path, {}))
+                merged.update(properties)
+                changed[obj_path] = merged
+                if invalid:
+                    invalidated[obj_path] = sorted(
+                        set(invalidated.get(obj_path, ())) | invalid)
+        frame = encode_frame(full, generation, changed, invalidated, removed)
+        self.generation = self.journal.generation
+        for writer in list(self.clients):
+            if writer.transport.get_write_buffer_size() > MAX_CLIENT_BUFFER:
+                log.warning('Disconnecting slow export client')
+                self.clients.remove(writer)
+                writer.close()
+                continue
+            writer.write(frame)
+
+
+@asyncio.coroutine
+def _read(socket_path):
+    reader, _ = yield from asyncio.open_unix_connection(socket_path)
+    state = StateReader()
+    while True:
+        data = yield from reader.read(65536)
+        if not data:
+            return
+        if state.feed(data):
+            print('generation %d: %d objects (%d bytes)' % (
+                state.generation, len(state.state), len(data)))
+
+
+def main(args=None):
+    ''' Reference reader printing the received state updates '''
+    args = sys.argv[1:] if args is None else args
+    if len(args) != 1:
+        print('Usage: python3 -m qubesdbus.export SOCKET', file=sys.stderr)
+        return 1
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(_read(args[0]))
+    loop.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -20,16 +20,25 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 ''' org.qubes.Labels1 service '''
 
+import argparse
 import asyncio
+import fcntl
+import functools
 import logging
+import os
 import sys
+import time
 
 import dbus
+import dbus.service
+import dbus.types
 from systemd.journal import JournalHandler
 
 import qubesadmin.label
+import qubesdbus.debug
 import qubesdbus.models
 import qubesdbus.serialize
+import qubesdbus.service
 from qubesdbus.service import ObjectManager
 
 SERVICE_NAME = "org.qubes.Labels1"
@@ -39,6 +48,41 @@ log = logging.getLogger(SERVICE_NAME)
 log.addHandler(JournalHandler(SYSLOG_IDENTIFIER='qubesdbus.labels'))
 log.setLevel(logging.INFO)
 
+# number of rendered icons kept in memory
+ICON_CACHE_SIZE = 64
+
+
+@functools.lru_cache(maxsize=ICON_CACHE_SIZE)
+def render_icon(icon: str, size: int) -> bytes:
+    ''' Render the themed icon `icon` at `size` pixels and return it as PNG
+        data.
+    '''
+    import gi
+    gi.require_version('Gtk', '3.0')
+    from gi.repository import Gtk  # pylint: disable=no-name-in-module
+
+    theme = Gtk.IconTheme.get_default()
+    pixbuf = theme.load_icon(icon, size, Gtk.IconLookupFlags.FORCE_SIZE)
+    success, data = pixbuf.save_to_bufferv('png', [], [])
+    assert success, "Failed to encode icon %s" % icon
+    return bytes(data)
+
+
+def sealed_memfd(name: str, data: bytes) -> int:
+    ''' Returns a sealed memfd containing `data`, the caller has to close it.
+    '''
+    fd = os.memfd_create(name, os.MFD_CLOEXEC | os.MFD_ALLOW_SEALING)
+    try:
+        os.write(fd, data)
+        os.lseek(fd, 0, os.SEEK_SET)
+        fcntl.fcntl(fd, fcntl.F_ADD_SEALS,
+                    fcntl.F_SEAL_SHRINK | fcntl.F_SEAL_GROW
+                    | fcntl.F_SEAL_WRITE | fcntl.F_SEAL_SEAL)
+    except Exception:
+        os.close(fd)
+        raise
+    return fd
+
 
 class Labels(ObjectManager):
     ''' A `org.freedesktop.DBus.ObjectManager` interface implementation, for
@@ -53,6 +97,78 @@ class Labels(ObjectManager):
             label = self._new_label(l)
             self.managed_objects.append(label)
 
+        self.debug = qubesdbus.debug.Debug(self.bus_name, SERVICE_PATH)
+        self.add_event_handler('label-add', self._label_add)
+        self.add_event_handler('label-delete', self._label_delete)
+
+    def _find_label(self, name):
+        for label in self.managed_objects:
+            if label.properties['name'] == name:
+                return label
+        raise KeyError(name)
+
+    def _label_add(self, _, __, label=None, **___):
+        if label is None:
+            return
+        self.app.labels.clear_cache()
+        label = self._new_label(self.app.labels[label])
+        self.managed_objects.append(label)
+        log.info('Added label %s', label.properties['name'])
+        self.Added(label._object_path)  # pylint: disable=protected-access
+
+    def _label_delete(self, _, __, label=None, **___):
+        self.app.labels.clear_cache()
+        try:
+            label = self._find_label(label)
+        except KeyError:
+            return
+        obj_path = label._object_path  # pylint: disable=protected-access
+        label.remove_from_connection()
+        self.managed_objects.remove(label)
+        log.info('Removed label %s', label.properties['name'])
+        self.Removed(obj_path)
+
+    def _icon_data(self, name, size):
+        try:
+            icon = self._find_label(name).properties['icon']
+        except KeyError:
+            raise dbus.DBusException("Label %s does not exist" % name,
+                                     name="UnknownLabel")
+        try:
+            return render_icon(str(icon), int(size))
+        except Exception as e:  # pylint: disable=broad-except
+            raise dbus.DBusException(
+                "Failed to render icon %s: %s" % (icon, e),
+                name="IconError")
+
+    @dbus.service.method(SERVICE_NAME, in_signature="su", out_signature="ay")
+    def GetIcon(self, name, size):
+        ''' Returns the icon of label `name` rendered at `size` pixels as PNG
+            data. Rendered icons are cached.
+        '''
+        return dbus.ByteArray(self._icon_data(name, size))
+
+    @dbus.service.method(SERVICE_NAME, in_signature="su", out_signature="h")
+    def GetIconFd(self, name, size):
+        ''' Like `GetIcon`, but returns a sealed memfd with the PNG data '''
+        data = self._icon_data(name, size)
+        if not hasattr(os, 'memfd_create'):
+            raise dbus.DBusException("memfd is not supported",
+                                     name="NotSupported")
+        fd = sealed_memfd('qubes-label-%s-%d' % (name, size), data)
+        try:
+            return dbus.types.UnixFd(fd)
+        finally:
+            os.close(fd)
+
+    @dbus.service.signal(SERVICE_NAME, signature="o")
+    def Added(self, obj_path):
+        ''' Emitted when a label is added '''
+
+    @dbus.service.signal(SERVICE_NAME, signature="o")
+    def Removed(self, obj_path):
+        ''' Emitted when a label is removed '''
+
     def _new_label(self,
                    label: qubesadmin.label.Label) -> qubesdbus.models.Label:
         data = {}  # type: Dict[str, Any]
@@ -65,13 +181,32 @@ class Labels(ObjectManager):
         return qubesdbus.models.Label(self.bus_name, SERVICE_PATH, data)
 
 
+parser = argparse.ArgumentParser(description=__doc__)
+qubesdbus.service.add_arguments(parser)
+
+
 def main(args=None):
-    ''' Main function '''  # pylint: disable=unused-argument
+    ''' Main function '''
+    started = time.monotonic()
+    args = parser.parse_args(args)
+    qubesdbus.service.setup_loop()
     manager = Labels()
+    qubesdbus.service.report_startup(SERVICE_NAME, started, False)
     loop = asyncio.get_event_loop()
-    loop.run_until_complete(manager.run())
-    loop.stop()
-    loop.run_forever()
+    tasks = [asyncio.ensure_future(manager.run())]
+    if args.idle_timeout:
+        # the few labels are quickly loaded again, no checkpoint is needed
+        idle = qubesdbus.service.IdleMonitor(manager.bus, args.idle_timeout)
+        idle.busy.append(lambda: manager.subscriptions.clients)
+        tasks.append(asyncio.ensure_future(idle.run()))
+    done, pending = loop.run_until_complete(asyncio.wait(
+        tasks, return_when=asyncio.FIRST_COMPLETED))
+    for task in done:
+        # raise an exception, if any
+        task.result()
+    if pending:  # idle
+        manager.bus.release_name(SERVICE_NAME)
+    qubesdbus.service.cancel_tasks(pending)
     loop.close()
     return 0
 
@@ -25,9 +25,10 @@ Contains the folowing interface implementations:
 * *org.qubes.Label*
 '''
 
+import enum
 import os.path
 import subprocess
-from typing import Any, Dict, Union
+from typing import Any, Callable, Dict, Union
 
 import dbus
 import dbus.service
@@ -45,26 +46,36 @@ class Domain(qubesdbus.service.PropertiesObject):
         object path is `/org/qubes/DomainManager1/domains/QID`
     '''
     INTERFACE = 'org.qubes.Domain'
+    VOLATILE_PROPERTIES = frozenset(
+        ['memory_usage', 'cpu_time', 'cpu_usage', 'memory_trend'])
+    # changed by `Set`, which validates the transition and signals it
+    TRANSITION_PROPERTIES = frozenset(['state'])
 
     def __init__(self, bus_name: BusName, path_prefix: str,
-                 data: Dict[Union[str, dbus.String], Any]) -> None:
+                 data: Dict[Union[str, dbus.String], Any],
+                 state_changed: Callable[['Domain', str], None] = None
+                ) -> None:
         obj_path = os.path.join(path_prefix, 'domains', str(data['qid']))
 
         super().__init__(bus_name, obj_path, Domain.INTERFACE, data)
 
         self.name = data['name']
+        self.state_changed = state_changed
 
     @dbus.service.method(dbus_interface="org.freedesktop.DBus.Properties")
     def Set(self, interface, name,
             value):  # type: (str, dbus.String, Any) -> None
         ''' Set a property value. '''
         if name == 'state':
-            cur_state = self.properties[name]
-            state = value
-            # Uncomment validation for more stability
-            # if not valid_state_change(cur_state, state):
-            #     msg = "State can't change from %s to %s" % (cur_state, state)
-            #     raise ValidationException(msg)
+            cur_state = self.properties.get(name)
+            if cur_state != value and not valid_state_change(cur_state,
+                                                             value):
+                msg = "State can't change from %s to %s" % (cur_state, value)
+                raise ValidationException(msg)
+            super().Set(interface, name, value)
+            if cur_state != value and self.state_changed is not None:
+                self.state_changed(self, value)
+            return
         super().Set(interface, name, value)
 
     @dbus.service.method("org.qubes.Domain", out_signature="b")
@@ -103,38 +114,69 @@ class Domain(qubesdbus.service.PropertiesObject):
         return True
 
 
+class DomainState(enum.Enum):
+    ''' User consumable domain states. They don't map one to one to the power
+        states provided by qubesadmin, see
+        `qubesdbus.serialize.serialize_state`.
+    '''
+    UNKNOWN = 'Unknown'
+    FAILED = 'Failed'
+    HALTED = 'Halted'
+    STARTING = 'Starting'
+    STARTED = 'Started'
+    HALTING = 'Halting'
+
+
+# Allowed transitions, `DomainState.UNKNOWN` and `DomainState.FAILED` are
+# always reachable and are not listed here.
+_STATE_TRANSITIONS = frozenset([
+    (DomainState.UNKNOWN, DomainState.HALTED),
+    (DomainState.UNKNOWN, DomainState.STARTING),
+    (DomainState.UNKNOWN, DomainState.STARTED),
+    (DomainState.UNKNOWN, DomainState.HALTING),
+    (DomainState.FAILED, DomainState.STARTING),
+    (DomainState.FAILED, DomainState.HALTED),
+    (DomainState.HALTED, DomainState.STARTING),
+    (DomainState.STARTING, DomainState.STARTED),
+    (DomainState.STARTING, DomainState.HALTED),
+    (DomainState.STARTED, DomainState.HALTING),
+    (DomainState.STARTED, DomainState.HALTED),
+    (DomainState.HALTING, DomainState.HALTED),
+    (DomainState.HALTING, DomainState.STARTED),
+])
+
+
 def valid_state_change(cur_state: DBusString, state: DBusString) -> bool:
     ''' Validates the state changes of a domain. This state don't map one to
         one to the states provided by qubesadmin. The purpose of this states is
         to be user consumable.
         Valid state changes are:
-        * UNKNOWN → [STARTED|HALTING]  — workaround Transient state bug
-        * FAILED  → STARTING
+        * UNKNOWN → [HALTED|STARTING|STARTED|HALTING]
+        * FAILED  → [STARTING|HALTED]
         * HALTED  → STARTING
-        * STARTING → [FAILED|STARTED|HALTED]
-        * STARTED → [FAILED|HALTING]
-        * HALTING → [FAILED|HALTED]
-    '''  # pylint: disable=too-many-boolean-expressions
-    all_states = [
-        'Unknown', 'Failed', 'Halted', 'Starting', 'Started', 'Halting'
-    ]
-
-    if cur_state == state:  # theoretically DBus should take care of this
+        * STARTING → [STARTED|HALTED]
+        * STARTED → [HALTING|HALTED]  — halted without halting on kill
+        * HALTING → [HALTED|STARTED]  — started again when shutdown failed
+        * any → [FAILED|UNKNOWN]
+    '''
+    try:
+        new = DomainState(state)
+    except ValueError:
         return False
-    elif cur_state is None and state in all_states\
-      or state == 'Unknown' \
-      or (cur_state == 'Unknown' and state in ['Started', 'Halting']) \
-      or (cur_state == 'Failed'   and state == 'Starting')\
-      or (cur_state == 'Halted'   and state == 'Starting')\
-      or (cur_state == 'Starting' and state == 'Started')\
-      or (cur_state == 'Starting' and state == 'Halted')\
-      or (cur_state == 'Started'  and state == 'Halting')\
-      or (cur_state == 'Halting'  and state == 'Halted'):
-        return True
-    elif state == 'Failed':
+
+    if cur_state is None:
         return True
 
-    return False
+    try:
+        cur = DomainState(cur_state)
+    except ValueError:
+        return True  # garbage in the current state, let it be fixed
+
+    if cur == new:  # theoretically DBus should take care of this
+        return False
+    elif new in (DomainState.UNKNOWN, DomainState.FAILED):
+        return True
+    return (cur, new) in _STATE_TRANSITIONS
 
 
 class Label(qubesdbus.service.PropertiesObject):
@@ -52,20 +52,24 @@ def qubes_data(app):
     return result
 
 
+_POWER_STATES = {
+    'crashed': 'Failed',
+    'halted': 'Halted',
+    'transient': 'Starting',
+    'running': 'Started',
+    'paused': 'Started',
+    'suspended': 'Started',
+    'halting': 'Halting',
+    'dying': 'Halting',
+    'na': 'Unknown',
+}
+
+
 def serialize_state(state):
-    state = state.lower()
-    if state == 'crashed':
-        return 'Failed'
-    elif state in ['transient', 'na']:
-        return 'Unknown'
-    elif state == 'halted':
-        return 'Halted'
-    elif state == 'transient':
-        return 'Starting'
-    elif state == 'running':
-        return 'Started'
-    else:
-        return '=>%s<=' % state
+    ''' Map a qubesadmin power state to a `qubesdbus.models.DomainState`
+        value
+    '''
+    return _POWER_STATES.get(state.lower(), 'Unknown')
 
 
 def domain_data(vm: QubesVM) -> Dict[dbus.String, Any]:
@@ -86,9 +90,10 @@ def domain_data(vm: QubesVM) -> Dict[dbus.String, Any]:
     else:
         result['networked'] = serialize_val(vm.is_networked())
 
-    result['memory_usage'] = 0
-    result['cpu_time'] = 0
-    result['cpu_usage'] = 0
+    result['memory_usage'] = dbus.Int64(0)
+    result['cpu_time'] = dbus.Int64(0)
+    result['cpu_usage'] = dbus.Int64(0)
+    result['memory_trend'] = dbus.Double(0)
     return result
 
 
@@ -151,6 +156,10 @@ def label_path(label: Label) -> dbus.ObjectPath:
     return dbus.ObjectPath('/org/qubes/Labels1/labels/' + label.name)
 
 
-def domain_path(vm: QubesVM) -> dbus.ObjectPath:
-    ''' Return the D-Bus object path for a `qubes.vm.qubesvm.QubesVM` '''
-    return dbus.ObjectPath('/org/qubes/DomainManager1/domains/' + str(vm.qid))
+def domain_path(vm: QubesVM, qid: int = None) -> dbus.ObjectPath:
+    ''' Return the D-Bus object path for a `qubes.vm.qubesvm.QubesVM`. A
+        known `qid` saves reading it from qubesd.
+    '''
+    if qid is None:
+        qid = vm.qid
+    return dbus.ObjectPath('/org/qubes/DomainManager1/domains/' + str(qid))
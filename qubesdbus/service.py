@@ -21,21 +21,702 @@
 ''' Service classes '''
 
 import asyncio
+import collections
+import hashlib
 import logging
-from typing import Any
+import os
+import stat
+import time
+from typing import Any, Callable, Dict, List, Tuple
 
 import dbus
-import dbus.mainloop.glib
+import dbus.lowlevel
 import dbus.service
 from dbus.service import BusName
 from systemd.journal import JournalHandler
 
-import gbulb
 from qubesadmin import Qubes
 from qubesadmin.events import EventsDispatcher
 
-gbulb.install()
-dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+import qubesdbus.export
+
+log = logging.getLogger('qubesdbus.service')
+
+
+def setup_loop() -> None:
+    ''' Install the GLib based asyncio event loop and make GLib the default
+        D-Bus main loop. Has to be called by the service `main()` functions
+        before connecting to the bus.
+    '''
+    import gbulb
+    import dbus.mainloop.glib
+    gbulb.install()
+    dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+
+
+class PropertiesChangedQueue(object):
+    ''' Collects the property changes of all `PropertiesObject`s during one
+        event loop iteration and emits them in one batch at the end of it.
+        Multiple updates to the same object are merged into a single
+        `PropertiesChanged` signal. Signals announcing a change, like
+        `Started`, are queued with `add_signal` and emitted right after the
+        `PropertiesChanged` of their object.
+    '''
+
+    def __init__(self) -> None:
+        # PropertiesObject → (changed properties, invalidated properties,
+        #                     signals to emit afterwards)
+        self.pending = collections.OrderedDict()
+        self.scheduled = False
+        # called with (object, changed properties, invalidated) on flush
+        self.listeners = []  # type: List[Callable]
+
+    def _entry(self, obj):
+        try:
+            entry = self.pending[obj]
+        except KeyError:
+            entry = self.pending[obj] = ({}, set(), [])
+        if not self.scheduled:
+            asyncio.get_event_loop().call_soon(self.flush)
+            self.scheduled = True
+        return entry
+
+    def add(self, obj, changed_properties, invalidated=()) -> None:
+        ''' Queue a property change of `obj` '''
+        changed, invalid, _ = self._entry(obj)
+        for name, value in changed_properties.items():
+            changed[name] = value
+            invalid.discard(name)
+        for name in invalidated:
+            changed.pop(name, None)
+            invalid.add(name)
+
+    def add_signal(self, obj, signal: Callable, *args) -> None:
+        ''' Queue `signal(*args)`, emitted after the queued
+            `PropertiesChanged` of `obj`
+        '''
+        self._entry(obj)[2].append((signal, args))
+
+    def flush(self) -> None:
+        ''' Emit all queued changes and flush the bus connections once '''
+        pending, self.pending = self.pending, collections.OrderedDict()
+        self.scheduled = False
+        connections = set()
+        for obj, (changed, invalid, signals) in pending.items():
+            connections.add(obj.bus)
+            if changed or invalid:
+                invalid = sorted(invalid)
+                obj.PropertiesChanged(obj.iface, changed, invalid)
+                for listener in self.listeners:
+                    listener(obj, changed, invalid)
+            for signal, args in signals:
+                signal(*args)
+        for connection in connections:
+            connection.flush()
+
+
+PROPERTIES_CHANGED = PropertiesChangedQueue()
+
+
+# maximum number of queued events before the overflow policy kicks in
+EVENT_QUEUE_SIZE = 1024
+# events for which only the latest one per subject is processed
+COALESCED_EVENTS = frozenset(['vm-stats', 'device-list-change'])
+# events which are dropped first when the queue is full, all other events
+# (domain and device lifecycle) are never dropped
+DROPPABLE_EVENTS = frozenset(['vm-stats'])
+# maximum number of events handled in one event loop iteration, the changes
+# of a batch are emitted as one `PropertiesChanged` per object
+EVENT_BATCH_SIZE = 256
+
+
+class EventQueue(object):
+    ''' A bounded queue between the qubesd event streams and the event
+        handlers, so a slow handler or D-Bus consumer doesn't block reading
+        events.
+
+        When the queue is full, droppable events are discarded, starting
+        with the oldest queued one. Lifecycle events are never dropped, the
+        queue grows beyond its bound for them and an overflow is counted.
+    '''
+
+    def __init__(self, maxsize: int = EVENT_QUEUE_SIZE,
+                 coalesce=COALESCED_EVENTS, droppable=DROPPABLE_EVENTS,
+                 batch_size: int = EVENT_BATCH_SIZE) -> None:
+        self.maxsize = maxsize
+        self.batch_size = batch_size
+        self.coalesce = coalesce
+        self.droppable = droppable
+        # entries are [handler, subject, event, kwargs, coalesce_key]
+        self.queue = collections.deque()  # type: collections.deque
+        self.coalesced = {}  # type: Dict[tuple, list]
+        self.wakeup = asyncio.Event()
+        self.counters = {
+            'max_depth': 0,
+            'processed': 0,
+            'coalesced': 0,
+            'dropped': 0,
+            'overflows': 0,
+        }
+
+    def put(self, handler, subject, event, kwargs) -> None:
+        ''' Queue `handler(subject, event, **kwargs)` '''
+        kind = event.split(':', 1)[0]
+        key = None
+        if kind in self.coalesce:
+            key = (handler, event, getattr(subject, 'name', subject))
+            try:
+                entry = self.coalesced[key]
+                entry[1] = subject
+                entry[3] = kwargs
+                self.counters['coalesced'] += 1
+                return
+            except KeyError:
+                pass
+
+        if len(self.queue) >= self.maxsize:
+            if kind in self.droppable:
+                self.counters['dropped'] += 1
+                return
+            if not self._drop_oldest():
+                self.counters['overflows'] += 1
+                log.warning('Event queue overflow (%d events), queueing %s',
+                            len(self.queue), event)
+
+        entry = [handler, subject, event, kwargs, key]
+        self.queue.append(entry)
+        if key is not None:
+            self.coalesced[key] = entry
+        self.counters['max_depth'] = max(self.counters['max_depth'],
+                                         len(self.queue))
+        self.wakeup.set()
+
+    def _drop_oldest(self) -> bool:
+        ''' Drop the oldest droppable event, returns `False` if there is none
+        '''
+        for idx, entry in enumerate(self.queue):
+            if entry[2].split(':', 1)[0] in self.droppable:
+                del self.queue[idx]
+                if entry[4] is not None:
+                    del self.coalesced[entry[4]]
+                self.counters['dropped'] += 1
+                return True
+        return False
+
+    def statistics(self) -> Dict[str, int]:
+        ''' Returns the current queue depth and the queue counters '''
+        result = dict(self.counters)
+        result['depth'] = len(self.queue)
+        return result
+
+    @asyncio.coroutine
+    def run(self):
+        ''' Process queued events, yielding to the event loop after each
+            batch of at most `batch_size` events
+        '''
+        while True:
+            if not self.queue:
+                self.wakeup.clear()
+                yield from self.wakeup.wait()
+                continue
+            self.process(self.batch_size)
+            yield from asyncio.sleep(0)
+
+    def process(self, count: int) -> int:
+        ''' Handle up to `count` queued events without yielding, returns the
+            number of handled events
+        '''
+        processed = 0
+        while self.queue and processed < count:
+            handler, subject, event, kwargs, key = self.queue.popleft()
+            if key is not None:
+                del self.coalesced[key]
+            handler(subject, event, **kwargs)
+            processed += 1
+        self.counters['processed'] += processed
+        return processed
+
+
+class Subscriptions(object):
+    ''' Per client property interest sets of a manager. Property changes of
+        the manager's objects are sent as unicast
+        `org.qubes.Subscription1.PropertiesChanged(o, a{sv}, as)` signals
+        from the manager path, containing only the subscribed properties of
+        the subscribed objects. Subscriptions are dropped when the client
+        disconnects from the bus.
+    '''
+
+    INTERFACE = 'org.qubes.Subscription1'
+
+    def __init__(self, manager: dbus.service.Object) -> None:
+        self.manager = manager
+        # pylint: disable=protected-access
+        self.prefix = manager._object_path + '/'
+        # unique bus name → (property names, object paths), empty means all
+        self.clients = {}  # type: Dict[str, Tuple[frozenset, frozenset]]
+        self.watches = {}  # type: Dict[str, Any]
+        PROPERTIES_CHANGED.listeners.append(self.notify)
+
+    def subscribe(self, sender: str, properties, objects) -> None:
+        ''' Replace the interest set of `sender` '''
+        self.clients[sender] = (frozenset(str(p) for p in properties),
+                                frozenset(str(o) for o in objects))
+        if sender not in self.watches:
+            self.watches[sender] = self.manager.bus.watch_name_owner(
+                sender, lambda owner: self._owner_changed(sender, owner))
+
+    def unsubscribe(self, sender: str) -> None:
+        ''' Drop the interest set of `sender` '''
+        self.clients.pop(sender, None)
+        watch = self.watches.pop(sender, None)
+        if watch is not None:
+            watch.cancel()
+
+    def _owner_changed(self, sender, owner):
+        if not owner:
+            self.unsubscribe(sender)
+
+    def notify(self, obj, changed, invalidated) -> None:
+        ''' Send the change of `obj` to all clients interested in it '''
+        obj_path = obj._object_path  # pylint: disable=protected-access
+        if not self.clients or not obj_path.startswith(self.prefix):
+            return
+        for client, (properties, objects) in self.clients.items():
+            if objects and obj_path not in objects:
+                continue
+            if properties:
+                client_changed = {k: v for k, v in changed.items()
+                                  if k in properties}
+                client_invalidated = [n for n in invalidated
+                                      if n in properties]
+            else:
+                client_changed, client_invalidated = changed, invalidated
+            if not client_changed and not client_invalidated:
+                continue
+            msg = dbus.lowlevel.SignalMessage(
+                self.manager._object_path,  # pylint: disable=protected-access
+                self.INTERFACE, 'PropertiesChanged')
+            msg.set_destination(client)
+            msg.append(dbus.ObjectPath(obj_path),
+                       dbus.Dictionary(client_changed, signature='sv'),
+                       dbus.Array(client_invalidated, signature='s'),
+                       signature='oa{sv}as')
+            self.manager.bus.send_message(msg)
+
+
+# number of object changes kept for `GetChangesSince`
+CHANGE_JOURNAL_SIZE = 4096
+
+
+class ChangeJournal(object):
+    ''' A monotonically increasing generation number and a bounded journal of
+        added, removed and changed objects. Used by the managers to send
+        clients only the changes since a generation they have seen.
+
+        The generation starts at the current time in microseconds, so a
+        generation from before a service restart is never mistaken for a
+        current one.
+    '''
+
+    def __init__(self, size: int = CHANGE_JOURNAL_SIZE) -> None:
+        self.generation = int(time.time() * 1000000)
+        self.start = self.generation
+        # entries are (generation, object path, kind, changed property names)
+        self.entries = collections.deque(maxlen=size)  # type: ignore
+        # called with (generation, object path, kind, names) on every change
+        self.listeners = []  # type: List[Callable]
+
+    def record(self, obj_path: str, kind: str, names=()) -> None:
+        ''' Record a change, `kind` is one of `added`, `removed` or `changed`
+        '''
+        self.generation += 1
+        entry = (self.generation, str(obj_path), kind, frozenset(names))
+        self.entries.append(entry)
+        for listener in self.listeners:
+            listener(*entry)
+
+    def since(self, generation: int):
+        ''' Returns the merged changes after `generation` as an ordered
+            mapping of object path to `(kind, names)`, or `None` when the
+            generation is unknown or has aged out of the journal.
+        '''
+        if generation > self.generation or generation < self.start:
+            return None
+        if self.entries and self.entries[0][0] > generation + 1:
+            return None
+
+        result = collections.OrderedDict()
+        for gen, obj_path, kind, names in self.entries:
+            if gen <= generation:
+                continue
+            if kind == 'changed' and obj_path in result:
+                prev_kind, prev_names = result[obj_path]
+                if prev_kind == 'changed':
+                    result[obj_path] = (kind, prev_names | names)
+                continue  # added objects are sent complete anyway
+            result[obj_path] = (kind, names)
+        return result
+
+    def changes_since(self, generation: int, objects):
+        ''' Returns a `GetChangesSince` reply for `objects`, a mapping of
+            object path to `PropertiesObject`. Falls back to a full snapshot
+            when `generation` is not in the journal anymore.
+        '''
+        changes = self.since(generation)
+        changed = dbus.Dictionary({}, signature='oa{sv}')
+        invalidated = dbus.Dictionary({}, signature='oas')
+        removed = dbus.Array([], signature='o')
+        if changes is None:
+            for obj_path, obj in objects.items():
+                changed[obj_path] = obj.properties
+            return (dbus.UInt64(self.generation), True, changed, invalidated,
+                    removed)
+
+        for obj_path, (kind, names) in changes.items():
+            if kind == 'removed':
+                if obj_path not in objects:
+                    removed.append(obj_path)
+                continue
+            try:
+                properties = objects[obj_path].properties
+            except KeyError:
+                continue
+            if kind == 'added':
+                changed[obj_path] = properties
+                continue
+            changed[obj_path] = dbus.Dictionary(
+                {n: properties[n] for n in names if n in properties},
+                signature='sv')
+            missing = [n for n in names if n not in properties]
+            if missing:
+                invalidated[obj_path] = dbus.Array(missing, signature='s')
+        return (dbus.UInt64(self.generation), False, changed, invalidated,
+                removed)
+
+
+def properties_digest(properties, ignore=()) -> bytes:
+    ''' A digest of a property dictionary, independent of the key order and
+        of the D-Bus wrapper types of the values.
+    '''
+    data = bytearray()
+    for name in sorted(properties):
+        if name not in ignore:
+            qubesdbus.export.encode_value(str(name), data)
+            qubesdbus.export.encode_value(properties[name], data)
+    return hashlib.sha1(data).digest()
+
+
+def select_properties(objects, paths, names):
+    ''' Returns the properties `names` (all if empty) of the objects at
+        `paths` as `a{oa{sv}}`. `objects` maps object paths to
+        `PropertiesObject`s. Unknown objects and properties are left out.
+    '''
+    names = frozenset(names)
+    result = dbus.Dictionary({}, signature='oa{sv}')
+    for obj_path in paths:
+        try:
+            properties = objects[obj_path].properties
+        except KeyError:
+            continue
+        if names:
+            properties = dbus.Dictionary(
+                {n: v for n, v in properties.items() if n in names},
+                signature='sv')
+        result[obj_path] = properties
+    return result
+
+
+# default interval of the periodic state verification in seconds
+VERIFY_INTERVAL = 600
+
+
+def add_arguments(parser, state: str = None) -> None:
+    ''' Add the options shared by the services to the argparse `parser`:
+        `--idle-timeout`, and for services exporting a `state` (e.g.
+        "domain") `--export-socket` and `--verify-interval`. Services with
+        a state write a checkpoint when idle.
+    '''
+    if state is None:
+        idle_help = 'exit after SECONDS without method calls or subscribers'
+    else:
+        parser.add_argument('--export-socket', metavar='PATH',
+                            help='export the %s state on this Unix socket, '
+                            'see qubesdbus.export' % state)
+        parser.add_argument('--verify-interval', metavar='SECONDS', type=int,
+                            default=VERIFY_INTERVAL,
+                            help='verify the %s state against qubesd every '
+                            'SECONDS, 0 disables it' % state
+                            + ' (default: %(default)s)')
+        idle_help = ('write a checkpoint and exit after SECONDS without '
+                     'method calls or subscribers')
+    parser.add_argument('--idle-timeout', metavar='SECONDS', type=int,
+                        default=0,
+                        help=idle_help + ', the service is restarted by bus '
+                        'activation, 0 disables it (default: %(default)s)')
+
+
+@asyncio.coroutine
+def verify_periodically(manager, interval: int):
+    ''' Run the `manager.verify()` coroutine every `interval` seconds, to
+        repair state diverged because of missed events.
+    '''
+    while True:
+        yield from asyncio.sleep(interval)
+        try:
+            yield from manager.verify()
+        except Exception:  # pylint: disable=broad-except
+            log.exception('Verification failed')
+
+
+def cancel_tasks(tasks) -> None:
+    ''' Cancel the unfinished `tasks` and wait until they are done, before
+        the event loop is closed
+    '''
+    pending = [task for task in tasks if not task.done()]
+    for task in pending:
+        task.cancel()
+    if pending:
+        asyncio.get_event_loop().run_until_complete(asyncio.wait(pending))
+
+
+def reply_async(func, reply_handler, error_handler) -> None:
+    ''' Run the blocking `func` in the default executor and answer a D-Bus
+        method call declared with `async_callbacks` with its result.
+    '''
+    reply_future(asyncio.get_event_loop().run_in_executor(None, func),
+                 reply_handler, error_handler)
+
+
+def reply_future(future, reply_handler, error_handler) -> None:
+    ''' Answer a D-Bus method call declared with `async_callbacks` with the
+        result of `future`, a future or coroutine.
+    '''
+    future = asyncio.ensure_future(future)
+
+    def done(future):
+        try:
+            result = future.result()
+        except Exception as e:  # pylint: disable=broad-except
+            error_handler(e)
+            return
+        if result is None:
+            reply_handler()
+        else:
+            reply_handler(result)
+
+    future.add_done_callback(done)
+
+
+class _ObjectPath(str):
+    ''' Marks an object path in a plain value, D-Bus types are not
+        picklable
+    '''
+
+
+def to_plain(value):
+    ''' Convert D-Bus values to plain picklable Python values '''
+    # pylint: disable=too-many-return-statements
+    if isinstance(value, dbus.ObjectPath):
+        return _ObjectPath(value)
+    elif isinstance(value, (bool, dbus.Boolean)):
+        return bool(value)
+    elif isinstance(value, int):
+        return int(value)
+    elif isinstance(value, float):
+        return float(value)
+    elif isinstance(value, str):
+        return str(value)
+    elif isinstance(value, dict):
+        return {to_plain(k): to_plain(v) for k, v in value.items()}
+    elif isinstance(value, tuple):
+        return tuple(to_plain(v) for v in value)
+    elif isinstance(value, list):
+        return [to_plain(v) for v in value]
+    return value
+
+
+def from_plain(value):
+    ''' Convert values converted by `to_plain` back to D-Bus values '''
+    # pylint: disable=too-many-return-statements
+    if isinstance(value, _ObjectPath):
+        return dbus.ObjectPath(value)
+    elif isinstance(value, bool):
+        return dbus.Boolean(value)
+    elif isinstance(value, int):
+        return dbus.Int64(value)
+    elif isinstance(value, float):
+        return dbus.Double(value)
+    elif isinstance(value, str):
+        return dbus.String(value)
+    elif isinstance(value, dict):
+        return dbus.Dictionary(
+            {from_plain(k): from_plain(v) for k, v in value.items()},
+            signature='sv')
+    elif isinstance(value, tuple):
+        return tuple(from_plain(v) for v in value)
+    elif isinstance(value, list):
+        return [from_plain(v) for v in value]
+    return value
+
+
+# seconds a service restored from a checkpoint may take to serve its objects
+RESUME_BUDGET = 0.5
+
+
+# first bytes of a checkpoint file, followed by an `encode_value` encoding
+CHECKPOINT_MAGIC = b'QDBC1'
+
+
+def checkpoint_path(service: str) -> str:
+    ''' Returns the checkpoint file path of `service`, or `None` without
+        `XDG_RUNTIME_DIR`, the only place private to the user
+    '''
+    directory = os.environ.get('XDG_RUNTIME_DIR')
+    if not directory:
+        return None
+    return os.path.join(directory, 'qubes-dbus', service + '.checkpoint')
+
+
+def _private(st: os.stat_result) -> bool:
+    ''' Whether `st` is owned and only accessible by the current user '''
+    return st.st_uid == os.getuid() and not st.st_mode & 0o077
+
+
+def _checkpoint_value(value):
+    ''' Convert a decoded checkpoint value back to the D-Bus types used by
+        `qubesdbus.serialize`
+    '''
+    # pylint: disable=too-many-return-statements
+    if isinstance(value, (dbus.ObjectPath, bytes)):
+        return value
+    elif isinstance(value, bool):
+        return dbus.Boolean(value)
+    elif isinstance(value, int):
+        return dbus.Int64(value)
+    elif isinstance(value, float):
+        return dbus.Double(value)
+    elif isinstance(value, str):
+        return dbus.String(value)
+    elif isinstance(value, dict):
+        return dbus.Dictionary(
+            {k: _checkpoint_value(v) for k, v in value.items()},
+            signature='sv')
+    # the only arrays in properties are device lists
+    return dbus.Array([_checkpoint_value(v) for v in value],
+                      signature='a{sv}')
+
+
+def write_checkpoint(service: str, objects, state=None) -> None:
+    ''' Write the properties of the exported `objects` (a mapping of object
+        path to `PropertiesObject`) and the service specific `state`, so a
+        reactivated service can serve them before querying qubesd.
+    '''
+    path = checkpoint_path(service)
+    if path is None:
+        log.warning('XDG_RUNTIME_DIR is not set, no checkpoint written')
+        return
+    directory = os.path.dirname(path)
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    st = os.lstat(directory)
+    if not stat.S_ISDIR(st.st_mode) or not _private(st):
+        log.error('%s is not a private directory, no checkpoint written',
+                  directory)
+        return
+    data = bytearray(CHECKPOINT_MAGIC)
+    qubesdbus.export.encode_value({
+        'objects': {p: o.properties for p, o in objects.items()},
+        'state': state or {},
+    }, data)
+    fd = os.open(path + '.tmp',
+                 os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_NOFOLLOW, 0o600)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.rename(path + '.tmp', path)
+    log.info('Checkpoint of %d objects written to %s', len(objects), path)
+
+
+def read_checkpoint(service: str):
+    ''' Read and remove the checkpoint of `service`. Returns a dictionary
+        with the `objects` properties and the `state`, or `None` if there is
+        no usable checkpoint.
+    '''
+    path = checkpoint_path(service)
+    if path is None:
+        return None
+    try:
+        fd = os.open(path, os.O_RDONLY | os.O_NOFOLLOW)
+    except FileNotFoundError:
+        return None
+    except OSError as e:
+        log.error('Ignoring checkpoint %s: %s', path, e)
+        return None
+    with os.fdopen(fd, 'rb') as f:
+        os.unlink(path)  # a checkpoint is only valid for one start
+        if not _private(os.fstat(f.fileno())) \
+                or not _private(os.lstat(os.path.dirname(path))):
+            log.error('Ignoring checkpoint %s, accessible by other users',
+                      path)
+            return None
+        data = f.read()
+    try:
+        if not data.startswith(CHECKPOINT_MAGIC):
+            raise ValueError('Not a checkpoint')
+        checkpoint, _ = qubesdbus.export.decode_value(data,
+                                                      len(CHECKPOINT_MAGIC))
+        return {
+            'objects': {p: _checkpoint_value(properties)
+                        for p, properties in checkpoint['objects'].items()},
+            'state': _checkpoint_value(checkpoint['state']),
+        }
+    except Exception:  # pylint: disable=broad-except
+        log.exception('Ignoring unreadable checkpoint %s', path)
+        return None
+
+
+def report_startup(service: str, started: float, restored: bool) -> None:
+    ''' Log the time from `started` until the event loop runs and the
+        objects are served. A resume from a checkpoint taking longer than
+        `RESUME_BUDGET` is logged as warning.
+    '''
+    def report():
+        elapsed = time.monotonic() - started
+        if restored and elapsed > RESUME_BUDGET:
+            log.warning('%s resumed in %.3fs, over the budget of %.3fs',
+                        service, elapsed, RESUME_BUDGET)
+        else:
+            log.info('%s %s in %.3fs', service,
+                     'resumed' if restored else 'started', elapsed)
+
+    asyncio.get_event_loop().call_soon(report)
+
+
+class IdleMonitor(object):
+    ''' Tracks the method calls received on `bus`. `run()` returns once
+        there was no call for `timeout` seconds and none of the `busy`
+        callables returns true, e.g. because of subscribed clients.
+    '''
+
+    def __init__(self, bus: dbus.Bus, timeout: int) -> None:
+        self.timeout = timeout
+        self.last_activity = time.monotonic()
+        self.busy = []  # type: List[Callable]
+        bus.add_message_filter(self._message_filter)
+
+    def _message_filter(self, _, message):
+        if isinstance(message, dbus.lowlevel.MethodCallMessage):
+            self.last_activity = time.monotonic()
+
+    @asyncio.coroutine
+    def run(self):
+        while True:
+            remaining = self.last_activity + self.timeout - time.monotonic()
+            if remaining > 0:
+                yield from asyncio.sleep(remaining)
+            elif any(busy() for busy in self.busy):
+                self.last_activity = time.monotonic()
+            else:
+                log.info('No activity for %ds', self.timeout)
+                return
 
 
 class DbusServiceObject(dbus.service.Object):
@@ -46,15 +727,84 @@ class DbusServiceObject(dbus.service.Object):
         if not hasattr(self, 'app'):
             self.app = Qubes()
         self.events_dispatcher = EventsDispatcher(self.app)
+        self.events_queue = None  # type: EventQueue
         super().__init__(bus_name=bus_name, object_path=obj_path)
         self.bus = bus_name.get_bus()
 
+    def add_event_handler(self, event: str, handler,
+                          dispatcher: EventsDispatcher = None,
+                          timestamped: bool = False) -> None:
+        ''' Register `handler` for `event`. The events are passed through
+            `self.events_queue` instead of being handled inline by the
+            dispatcher. With `timestamped` the handler gets the time the
+            event was received as `received` keyword argument, as the queue
+            may delay it.
+        '''
+        assert self.events_queue is not None, "No event queue"
+        queue = self.events_queue
+        if dispatcher is None:
+            dispatcher = self.events_dispatcher
+
+        def enqueue(subject, event, **kwargs):
+            if timestamped:
+                kwargs['received'] = time.time()
+            queue.put(handler, subject, event, kwargs)
+
+        dispatcher.add_handler(event, enqueue)
+
     @asyncio.coroutine
     def run(self):
-        yield from self.events_dispatcher.listen_for_events()
+        if self.events_queue is None:
+            yield from self.events_dispatcher.listen_for_events()
+        else:
+            yield from asyncio.gather(
+                self.events_dispatcher.listen_for_events(),
+                self.events_queue.run())
+
+
+class ManagerObject(dbus.service.Object):
+    ''' The methods shared by the managers: per client subscriptions,
+        batched property reads and event queue statistics. Subclasses set
+        `subscriptions` and `events_queue` and implement `objects()`.
+    '''
 
+    PROPERTIES_INTERFACE = 'org.qubes.Properties1'
 
-class ObjectManager(DbusServiceObject):
+    def objects(self) -> Dict[str, 'PropertiesObject']:
+        ''' Returns the managed objects by object path '''
+        raise NotImplementedError
+
+    @dbus.service.method(Subscriptions.INTERFACE, in_signature="asao",
+                         sender_keyword='sender')
+    def Subscribe(self, properties, objects, sender=None):
+        ''' Receive unicast `org.qubes.Subscription1.PropertiesChanged`
+            signals for `properties` of `objects`. Empty lists subscribe to
+            all properties or all objects. Replaces a previous subscription.
+        '''
+        self.subscriptions.subscribe(sender, properties, objects)
+
+    @dbus.service.method(Subscriptions.INTERFACE, sender_keyword='sender')
+    def Unsubscribe(self, sender=None):
+        ''' Cancel the subscription of the caller '''
+        self.subscriptions.unsubscribe(sender)
+
+    @dbus.service.method(PROPERTIES_INTERFACE, in_signature="aoas",
+                         out_signature="a{oa{sv}}")
+    def GetProperties(self, obj_paths, names):
+        ''' Returns the properties `names` (all if empty) of the objects
+            `obj_paths` in one call. Unknown objects and properties are left
+            out.
+        '''
+        return select_properties(self.objects(), obj_paths, names)
+
+    @dbus.service.method(dbus_interface="org.qubes.EventQueue1",
+                         out_signature="a{st}")
+    def GetEventQueueStats(self):
+        ''' Returns the event queue depth, drop and coalesce counters '''
+        return self.events_queue.statistics()
+
+
+class ObjectManager(DbusServiceObject, ManagerObject):
     ''' Provides a class implementing the `org.freedesktop.DBus.ObjectManager`
         interface.
     '''
@@ -67,6 +817,12 @@ class ObjectManager(DbusServiceObject):
         self.bus_name = bus_name
         self.bus = bus
         self.managed_objects = []  # type: List[PropertiesObject]
+        self.events_queue = EventQueue()
+        self.subscriptions = Subscriptions(self)
+
+    def objects(self):
+        return {o._object_path: o  # pylint: disable=protected-access
+                for o in self.managed_objects}
 
     @dbus.service.method(dbus_interface="org.freedesktop.DBus.ObjectManager",
                          out_signature="a{oa{sa{sv}}}")
@@ -84,6 +840,12 @@ class PropertiesObject(DbusServiceObject):
     # pylint: disable=invalid-name
     ''' Implements `org.freedesktop.DBus.Properties` interface. '''
 
+    # properties changing too often to be part of the digest
+    VOLATILE_PROPERTIES = frozenset()  # type: frozenset
+    # properties only changed through validated transitions, like a domain
+    # state, left out of the digest and of `update_properties`
+    TRANSITION_PROPERTIES = frozenset()  # type: frozenset
+
     def __init__(self, bus_name: BusName, obj_path: str, iface: str,
                  data: dict) -> None:
         assert iface, "No interface provided for PropertiesObject"
@@ -93,6 +855,8 @@ class PropertiesObject(DbusServiceObject):
         self.properties = data
         self.id = obj_path
         self.iface = iface
+        self.journal = None  # type: ChangeJournal
+        self._digest = None  # type: bytes
         self.log = logging.getLogger(obj_path)
         self.log.addHandler(
             JournalHandler(level=logging.DEBUG, SYSLOG_IDENTIFIER=obj_path))
@@ -129,8 +893,26 @@ class PropertiesObject(DbusServiceObject):
             pass
 
         self.properties[name] = value
-        self.PropertiesChanged(self.iface,
-                               {name: value}, [])
+        self.properties_changed({name: value})
+
+    def properties_changed(self, changed_properties, invalidated=(),
+                           record=True):
+        ''' Queue a `PropertiesChanged` signal. It is emitted at the end of
+            the current event loop iteration, merged with all other changes
+            of this object. With `record=False` the change is not added to
+            the change journal, used for high frequency properties.
+        '''
+        self._digest = None
+        PROPERTIES_CHANGED.add(self, changed_properties, invalidated)
+        if record and self.journal is not None:
+            self.journal.record(self._object_path, 'changed',
+                                list(changed_properties) + list(invalidated))
+
+    def queue_signal(self, signal: Callable, *args) -> None:
+        ''' Emit `signal(*args)` after the queued `PropertiesChanged` of
+            this object, so clients see the new values first
+        '''
+        PROPERTIES_CHANGED.add_signal(self, signal, *args)
 
     @dbus.service.signal(dbus_interface='org.freedesktop.DBus.Properties',
                          signature="sa{sv}as")
@@ -142,6 +924,49 @@ class PropertiesObject(DbusServiceObject):
         for name, value in changed_properties.items():
             self.log.debug('%s: Property %s changed %s', self.id, name, value)
 
+    def digest(self) -> bytes:
+        ''' Digest of the non volatile properties, see `properties_digest`
+        '''
+        if self._digest is None:
+            self._digest = properties_digest(self.properties,
+                                             self.unverified_properties())
+        return self._digest
+
+    def unverified_properties(self) -> frozenset:
+        ''' Names of the properties left out of the digest and of
+            `update_properties`
+        '''
+        return self.VOLATILE_PROPERTIES | self.TRANSITION_PROPERTIES
+
+    def update_properties(self, data, keep=()) -> bool:
+        ''' Replace the non volatile properties with `data`, emitting one
+            `PropertiesChanged` for the differences. Properties missing in
+            `data` are invalidated, except the ones in `keep`. The
+            `TRANSITION_PROPERTIES` are never changed here. Returns `True`
+            if anything changed.
+        '''
+        ignore = self.unverified_properties()
+        if properties_digest(data, ignore) == self.digest():
+            return False
+        changed = {}
+        for name, value in data.items():
+            if name in ignore:
+                continue
+            if self.properties.get(name) != value:
+                self.properties[name] = value
+                changed[name] = value
+        invalidated = [
+            name for name in self.properties
+            if name not in data and name not in keep and name not in ignore
+        ]
+        for name in invalidated:
+            del self.properties[name]
+        if not changed and not invalidated:
+            self._digest = None
+            return False
+        self.properties_changed(changed, invalidated)
+        return True
+
     def properties_iface(self):
         ''' A helper for wrapping the interface around properties. Used by
             `ObjectManager.GetManagedObjects`
@@ -0,0 +1,39 @@
+# -*- encoding: utf-8 -*-
+#
+# The Qubes OS Project, https://www.qubes-os.org/
+#
+# Copyright (C) 2016 Bahtiar `kalkin-` Gadimov <bahtiar@gadimov.de>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+''' Tests of the qubesdbus services '''
+
+import importlib.util
+import unittest
+
+# modules needed by the services, but not by the package itself
+DEPENDENCIES = ['dbus', 'gbulb', 'qubesadmin', 'systemd']
+
+
+def missing_dependencies(names=DEPENDENCIES):
+    ''' Returns the modules of `names` which are not installed '''
+    return [name for name in names if importlib.util.find_spec(name) is None]
+
+
+def skip_without(*names):
+    ''' Skip the decorated test when one of the modules `names` is missing
+    '''
+    missing = missing_dependencies(names)
+    return unittest.skipIf(missing,
+                           'missing dependencies: %s' % ', '.join(missing))
@@ -0,0 +1,142 @@
+# -*- encoding: utf-8 -*-
+#
+# The Qubes OS Project, https://www.qubes-os.org/
+#
+# Copyright (C) 2016 Bahtiar `kalkin-` Gadimov <bahtiar@gadimov.de>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+''' Tests of the binary state export codec and its reference reader '''
+
+import unittest
+
+import qubesdbus.tests
+
+try:
+    import dbus
+    import qubesdbus.export
+except ImportError:  # the tests are skipped
+    pass
+
+
+def snapshot():
+    return {
+        '/org/qubes/DomainManager1/domains/1': {
+            'name': 'work',
+            'qid': 1,
+            'netvm': dbus.ObjectPath('/org/qubes/DomainManager1/domains/2'),
+            'autostart': False,
+            'memory_trend': -1.5,
+            'tags': ['audiovm', 'wörk'],
+        },
+        '/org/qubes/DomainManager1/domains/2': {
+            'name': 'sys-firewall',
+            'qid': 2,
+            'icon': b'\x89PNG',
+        },
+    }
+
+
+@qubesdbus.tests.skip_without('dbus')
+class TC_00_Codec(unittest.TestCase):
+    def assertRoundTrip(self, value):
+        data = bytearray()
+        qubesdbus.export.encode_value(value, data)
+        decoded, pos = qubesdbus.export.decode_value(bytes(data), 0)
+        self.assertEqual(decoded, value)
+        self.assertIs(type(decoded) is dbus.ObjectPath,
+                      isinstance(value, dbus.ObjectPath))
+        self.assertEqual(pos, len(data))
+
+    def test_000_scalars(self):
+        for value in [True, False, 0, 1, -1, 63, -64, 2**62, -2**62, 0.25,
+                      '', 'wörk', b'', b'\x00\xff']:
+            with self.subTest(value=value):
+                self.assertRoundTrip(value)
+
+    def test_001_object_path(self):
+        self.assertRoundTrip(dbus.ObjectPath('/org/qubes/Labels1/labels/red'))
+
+    def test_002_containers(self):
+        self.assertRoundTrip(snapshot())
+        self.assertRoundTrip([[], {}, [1, ['a']]])
+
+    def test_003_unknown_tag(self):
+        with self.assertRaises(ValueError):
+            qubesdbus.export.decode_value(b'?', 0)
+
+
+@qubesdbus.tests.skip_without('dbus')
+class TC_01_StateReader(unittest.TestCase):
+    def setUp(self):
+        self.frames = [
+            qubesdbus.export.encode_frame(True, 10, snapshot(), {}, []),
+            qubesdbus.export.encode_frame(
+                False, 11,
+                {'/org/qubes/DomainManager1/domains/1': {'qid': 1,
+                                                         'label': 'red'},
+                 '/org/qubes/DomainManager1/domains/3': {'name': 'new'}},
+                {'/org/qubes/DomainManager1/domains/1': ['tags']},
+                ['/org/qubes/DomainManager1/domains/2']),
+        ]
+        self.expected = snapshot()
+        del self.expected['/org/qubes/DomainManager1/domains/2']
+        domain = self.expected['/org/qubes/DomainManager1/domains/1']
+        domain['label'] = 'red'
+        del domain['tags']
+        self.expected['/org/qubes/DomainManager1/domains/3'] = {
+            'name': 'new'}
+
+    def test_000_snapshot(self):
+        reader = qubesdbus.export.StateReader()
+        self.assertEqual(reader.feed(self.frames[0]), 1)
+        self.assertEqual(reader.state, snapshot())
+        self.assertEqual(reader.generation, 10)
+
+    def test_001_delta(self):
+        reader = qubesdbus.export.StateReader()
+        self.assertEqual(reader.feed(b''.join(self.frames)), 2)
+        self.assertEqual(reader.state, self.expected)
+        self.assertEqual(reader.generation, 11)
+        self.assertEqual(reader.buffer, b'')
+
+    def test_002_chunked(self):
+        data = b''.join(self.frames)
+        for size in [1, 3, 4, 5, 7, len(data) - 1]:
+            with self.subTest(size=size):
+                reader = qubesdbus.export.StateReader()
+                frames = 0
+                for start in range(0, len(data), size):
+                    frames += reader.feed(data[start:start + size])
+                self.assertEqual(frames, 2)
+                self.assertEqual(reader.state, self.expected)
+                self.assertEqual(reader.buffer, b'')
+
+    def test_003_incomplete(self):
+        reader = qubesdbus.export.StateReader()
+        self.assertEqual(reader.feed(self.frames[0][:3]), 0)
+        self.assertEqual(reader.feed(self.frames[0][3:-1]), 0)
+        self.assertIsNone(reader.generation)
+        self.assertEqual(reader.feed(self.frames[0][-1:]), 1)
+        self.assertEqual(reader.state, snapshot())
+
+    def test_004_snapshot_replaces_state(self):
+        reader = qubesdbus.export.StateReader()
+        reader.feed(self.frames[1])
+        reader.feed(self.frames[0])
+        self.assertEqual(reader.state, snapshot())
+
+
+if __name__ == '__main__':
+    unittest.main()
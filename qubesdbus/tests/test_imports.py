@@ -0,0 +1,43 @@
+# -*- encoding: utf-8 -*-
+#
+# The Qubes OS Project, https://www.qubes-os.org/
+#
+# Copyright (C) 2016 Bahtiar `kalkin-` Gadimov <bahtiar@gadimov.de>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+''' Import smoke test of the service modules '''
+
+import importlib
+import unittest
+
+from qubesdbus.constants import SERVICE_MODULES
+from qubesdbus.tests import DEPENDENCIES, skip_without
+
+
+class TC_00_Imports(unittest.TestCase):
+    def test_000_package(self):
+        importlib.import_module('qubesdbus')
+
+    @skip_without(*DEPENDENCIES)
+    def test_001_service_modules(self):
+        for name in SERVICE_MODULES + ['qubesdbus.debug',
+                                       'qubesdbus.device_shard',
+                                       'qubesdbus.export']:
+            with self.subTest(module=name):
+                importlib.import_module(name)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+# -*- encoding: utf-8 -*-
+#
+# The Qubes OS Project, https://www.qubes-os.org/
+#
+# Copyright (C) 2016 Bahtiar `kalkin-` Gadimov <bahtiar@gadimov.de>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+''' Tests of the domain state machine '''
+
+import unittest
+
+import qubesdbus.tests
+
+try:
+    import qubesdbus.models
+    from qubesdbus.models import DomainState, valid_state_change
+except ImportError:  # the tests are skipped
+    pass
+
+
+@qubesdbus.tests.skip_without('dbus', 'qubesadmin', 'systemd')
+class TC_00_StateChange(unittest.TestCase):
+    def test_000_lifecycle(self):
+        for cur, new in [('Halted', 'Starting'), ('Starting', 'Started'),
+                         ('Started', 'Halting'), ('Halting', 'Halted')]:
+            with self.subTest(cur=cur, new=new):
+                self.assertTrue(valid_state_change(cur, new))
+
+    def test_001_same_state(self):
+        for state in DomainState:
+            with self.subTest(state=state):
+                self.assertFalse(valid_state_change(state.value,
+                                                    state.value))
+
+    def test_002_always_reachable(self):
+        for state in DomainState:
+            for new in (DomainState.UNKNOWN, DomainState.FAILED):
+                if state == new:
+                    continue
+                with self.subTest(state=state, new=new):
+                    self.assertTrue(valid_state_change(state.value,
+                                                       new.value))
+
+    def test_003_transitions(self):
+        for cur in DomainState:
+            for new in DomainState:
+                if cur == new or new in (DomainState.UNKNOWN,
+                                         DomainState.FAILED):
+                    continue
+                with self.subTest(cur=cur, new=new):
+                    self.assertEqual(
+                        valid_state_change(cur.value, new.value),
+                        (cur, new) in qubesdbus.models._STATE_TRANSITIONS)
+
+    def test_004_not_listed(self):
+        self.assertFalse(valid_state_change('Halted', 'Started'))
+        self.assertFalse(valid_state_change('Halted', 'Halting'))
+        self.assertFalse(valid_state_change('Started', 'Starting'))
+        self.assertFalse(valid_state_change('Failed', 'Started'))
+
+    def test_005_unknown_current_state(self):
+        self.assertTrue(valid_state_change(None, 'Started'))
+        self.assertTrue(valid_state_change('Paused', 'Halted'))
+
+    def test_006_invalid_new_state(self):
+        self.assertFalse(valid_state_change('Halted', 'Paused'))
+        self.assertFalse(valid_state_change(None, 'Paused'))
+
+
+if __name__ == '__main__':
+    unittest.main()
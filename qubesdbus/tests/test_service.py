@@ -0,0 +1,173 @@
+# -*- encoding: utf-8 -*-
+#
+# The Qubes OS Project, https://www.qubes-os.org/
+#
+# Copyright (C) 2016 Bahtiar `kalkin-` Gadimov <bahtiar@gadimov.de>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+''' Tests of the service helper classes '''
+
+import unittest
+
+import qubesdbus.tests
+
+try:
+    import qubesdbus.service
+except ImportError:  # the tests are skipped
+    pass
+
+
+class Subject(object):
+    # pylint: disable=too-few-public-methods
+    def __init__(self, name):
+        self.name = name
+
+
+@qubesdbus.tests.skip_without('dbus', 'qubesadmin', 'systemd')
+class TC_00_EventQueue(unittest.TestCase):
+    def setUp(self):
+        self.queue = qubesdbus.service.EventQueue(maxsize=4)
+        self.handled = []
+
+    def handler(self, subject, event, **kwargs):
+        self.handled.append((subject.name, event, kwargs))
+
+    def test_000_order(self):
+        for name in ['a', 'b', 'c']:
+            self.queue.put(self.handler, Subject(name), 'domain-start', {})
+        self.assertEqual(self.queue.process(10), 3)
+        self.assertEqual([h[0] for h in self.handled], ['a', 'b', 'c'])
+        self.assertEqual(self.queue.statistics()['processed'], 3)
+        self.assertEqual(self.queue.statistics()['depth'], 0)
+
+    def test_001_coalesce(self):
+        self.queue.put(self.handler, Subject('a'), 'vm-stats', {'memory': 1})
+        self.queue.put(self.handler, Subject('b'), 'vm-stats', {'memory': 2})
+        self.queue.put(self.handler, Subject('a'), 'vm-stats', {'memory': 3})
+        self.assertEqual(self.queue.process(10), 2)
+        self.assertEqual(self.handled, [('a', 'vm-stats', {'memory': 3}),
+                                        ('b', 'vm-stats', {'memory': 2})])
+        self.assertEqual(self.queue.statistics()['coalesced'], 1)
+        self.assertEqual(self.queue.coalesced, {})
+
+    def test_002_coalesce_after_processing(self):
+        self.queue.put(self.handler, Subject('a'), 'vm-stats', {'memory': 1})
+        self.queue.process(10)
+        self.queue.put(self.handler, Subject('a'), 'vm-stats', {'memory': 2})
+        self.assertEqual(self.queue.process(10), 1)
+        self.assertEqual(len(self.handled), 2)
+
+    def test_003_not_coalesced(self):
+        self.queue.put(self.handler, Subject('a'), 'domain-start', {})
+        self.queue.put(self.handler, Subject('a'), 'domain-start', {})
+        self.assertEqual(self.queue.process(10), 2)
+
+    def test_004_drop_new(self):
+        for name in ['a', 'b', 'c', 'd', 'e']:
+            self.queue.put(self.handler, Subject(name), 'vm-stats', {})
+        stats = self.queue.statistics()
+        self.assertEqual(stats['depth'], 4)
+        self.assertEqual(stats['dropped'], 1)
+        self.assertEqual(stats['overflows'], 0)
+        self.queue.process(10)
+        self.assertEqual([h[0] for h in self.handled], ['a', 'b', 'c', 'd'])
+
+    def test_005_drop_oldest_for_lifecycle(self):
+        self.queue.put(self.handler, Subject('a'), 'domain-start', {})
+        self.queue.put(self.handler, Subject('b'), 'vm-stats', {})
+        self.queue.put(self.handler, Subject('c'), 'vm-stats', {})
+        self.queue.put(self.handler, Subject('d'), 'domain-start', {})
+        self.queue.put(self.handler, Subject('e'), 'domain-shutdown', {})
+        stats = self.queue.statistics()
+        self.assertEqual(stats['depth'], 4)
+        self.assertEqual(stats['dropped'], 1)
+        self.assertEqual(stats['overflows'], 0)
+        self.queue.process(10)
+        self.assertEqual([h[0] for h in self.handled], ['a', 'c', 'd', 'e'])
+        self.assertEqual(self.queue.coalesced, {})
+
+    def test_006_overflow(self):
+        for name in ['a', 'b', 'c', 'd', 'e', 'f']:
+            self.queue.put(self.handler, Subject(name), 'domain-start', {})
+        self.queue.put(self.handler, Subject('g'), 'vm-stats', {})
+        stats = self.queue.statistics()
+        self.assertEqual(stats['depth'], 6)
+        self.assertEqual(stats['overflows'], 2)
+        self.assertEqual(stats['dropped'], 1)
+        self.assertEqual(stats['max_depth'], 6)
+
+    def test_007_batch(self):
+        for name in ['a', 'b', 'c']:
+            self.queue.put(self.handler, Subject(name), 'domain-start', {})
+        self.assertEqual(self.queue.process(2), 2)
+        self.assertEqual(self.queue.statistics()['depth'], 1)
+        self.assertEqual(self.queue.process(2), 1)
+        self.assertEqual(self.queue.process(2), 0)
+
+
+@qubesdbus.tests.skip_without('dbus', 'qubesadmin', 'systemd')
+class TC_01_ChangeJournal(unittest.TestCase):
+    def setUp(self):
+        self.journal = qubesdbus.service.ChangeJournal(size=3)
+        self.start = self.journal.generation
+
+    def test_000_empty(self):
+        self.assertEqual(self.journal.since(self.start), {})
+
+    def test_001_unknown_generation(self):
+        self.journal.record('/a', 'changed', ['name'])
+        self.assertIsNone(self.journal.since(self.start - 1))
+        self.assertIsNone(self.journal.since(self.start + 2))
+        self.assertEqual(self.journal.since(self.start + 1), {})
+
+    def test_002_merge(self):
+        self.journal.record('/a', 'changed', ['name'])
+        self.journal.record('/b', 'added')
+        self.journal.record('/a', 'changed', ['label'])
+        self.assertEqual(self.journal.since(self.start), {
+            '/a': ('changed', frozenset(['name', 'label'])),
+            '/b': ('added', frozenset()),
+        })
+        self.assertEqual(self.journal.since(self.start + 1), {
+            '/b': ('added', frozenset()),
+            '/a': ('changed', frozenset(['label'])),
+        })
+
+    def test_003_added_stays_added(self):
+        self.journal.record('/a', 'added')
+        self.journal.record('/a', 'changed', ['name'])
+        self.assertEqual(self.journal.since(self.start),
+                         {'/a': ('added', frozenset())})
+
+    def test_004_aging(self):
+        for _ in range(5):
+            self.journal.record('/a', 'changed', ['name'])
+        self.assertEqual(len(self.journal.entries), 3)
+        self.assertIsNone(self.journal.since(self.start))
+        self.assertIsNone(self.journal.since(self.start + 1))
+        self.assertEqual(self.journal.since(self.start + 2),
+                         {'/a': ('changed', frozenset(['name']))})
+        self.assertEqual(self.journal.since(self.start + 5), {})
+
+    def test_005_listeners(self):
+        calls = []
+        self.journal.listeners.append(lambda *args: calls.append(args))
+        self.journal.record('/a', 'removed')
+        self.assertEqual(calls, [(self.start + 1, '/a', 'removed',
+                                  frozenset())])
+
+
+if __name__ == '__main__':
+    unittest.main()